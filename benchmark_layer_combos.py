@@ -0,0 +1,241 @@
+#! /usr/bin/env python3
+#######################################################################################################################
+#  License: MIT (see LICENSE)
+#
+#######################################################################################################################
+#
+# Benchmarks the stages of export_layer_combos.py on synthetic Inkscape documents.
+#
+# A document is generated with a configurable number of groups, combo-children layers, nesting depth and embedded image
+# size, and every stage of an export (finding layers, expanding combos, serializing combo SVGs, rendering and
+# converting) is timed on its own. Rendering goes through a stub renderer by default, so Inkscape doesn't have to be
+# installed. Results are printed (or written) as JSON, and '--compare' prints how a run stacks up against an earlier
+# result file, e.g.:
+#
+#   python3 benchmark_layer_combos.py --layers=20 --axes=2 --output=before.json
+#   ... change things ...
+#   python3 benchmark_layer_combos.py --layers=20 --axes=2 --compare=before.json
+#
+#######################################################################################################################
+
+import argparse
+import base64
+import io
+import json
+import logging
+import platform
+import random
+import statistics
+import struct
+import sys
+import time
+import zlib
+
+# Imported first, since it adds Inkscape's extension directory (where inkex lives) to the path.
+import export_layer_combos
+import inkex
+
+#######################################################################################################################
+
+
+def encode_png(width: int, height: int, pixels: bytes) -> bytes:
+    """Returns an 8 bit RGBA PNG of 'pixels' (rows of width * 4 bytes) without needing Pillow."""
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    stride = width * 4
+    rows = b"".join(b"\x00" + pixels[y * stride:(y + 1) * stride] for y in range(height))
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)) + \
+        chunk(b"IDAT", zlib.compress(rows, 1)) + chunk(b"IEND", b"")
+
+
+def generate_document(groups: int, axes: int, layers: int, depth: int, static: int, image_kb: int,
+                      seed: int) -> bytes:
+    """Returns a synthetic Inkscape SVG. Every group has 'axes' combo-children layers with 'layers' children each
+       (so layers ** axes combos), every child is nested 'depth' layers deep, and every group has 'static' visible
+       layers. If 'image_kb' is above 0, each static layer embeds a PNG of roughly that many kilobytes.
+    """
+    rng = random.Random(seed)
+    parts = ['<svg xmlns="http://www.w3.org/2000/svg" xmlns:xlink="http://www.w3.org/1999/xlink" '
+             'xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape" '
+             'xmlns:sodipodi="http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd" '
+             'width="250mm" height="350mm" viewBox="0 0 250 350" id="svg">',
+             '<sodipodi:namedview id="namedview" pagecolor="#ffffff"/>']
+
+    image = ""
+    if image_kb > 0:
+        side = max(1, int((image_kb * 1024 / 4) ** 0.5))
+        pixels = bytes(rng.getrandbits(8) for _ in range(side * side * 4))
+        image = base64.b64encode(encode_png(side, side, pixels)).decode("ascii")
+
+    def shapes(prefix: str) -> str:
+        return "".join(f'<path id="{prefix}-p{i}" d="M {rng.uniform(0, 250):.2f},{rng.uniform(0, 350):.2f} '
+                       f'l {rng.uniform(-50, 50):.2f},{rng.uniform(-50, 50):.2f} h 10 z" '
+                       f'style="fill:#{rng.getrandbits(24):06x}"/>' for i in range(3))
+
+    for g in range(groups):
+        for s in range(static):
+            parts.append(f'<g inkscape:groupmode="layer" id="g{g}-s{s}" inkscape:label="Static {g}.{s}" '
+                         f'export-layer-combo="group{g},visible">{shapes(f"g{g}-s{s}")}')
+            if image:
+                parts.append(f'<image id="g{g}-s{s}-image" x="0" y="0" width="250" height="350" '
+                             f'xlink:href="data:image/png;base64,{image}"/>')
+            parts.append('</g>')
+        for a in range(axes):
+            parts.append(f'<g inkscape:groupmode="layer" id="g{g}-a{a}" inkscape:label="Axis {g}.{a}" '
+                         f'export-layer-combo="group{g},combo-children">')
+            for l in range(layers):
+                for d in range(depth):
+                    parts.append(f'<g inkscape:groupmode="layer" id="g{g}-a{a}-l{l}-d{d}" '
+                                 f'inkscape:label="Layer {a}.{l}.{d}" style="display:none">')
+                    parts.append(shapes(f"g{g}-a{a}-l{l}-d{d}"))
+                parts.append('</g>' * depth)
+            parts.append('</g>')
+
+    parts.append('</svg>')
+    return "".join(parts).encode("utf-8")
+
+
+class StubRenderer(object):
+    """Stands in for Inkscape: returns a blank PNG of the size Inkscape would render the page at."""
+
+    def __init__(self, width: float, height: float):
+        self.width = width
+        self.height = height
+        self.cache = dict()
+
+    def render(self, svg: bytes, dpi: float, logit, background_opacity: float = None, area: str = None) -> bytes:
+        size = (max(1, round(self.width * dpi / 96.0)), max(1, round(self.height * dpi / 96.0)))
+        if size not in self.cache:
+            self.cache[size] = encode_png(size[0], size[1], b"\xff" * (size[0] * size[1] * 4))
+        return self.cache[size]
+
+    def close(self):
+        pass
+
+
+class StageTimer(object):
+    """Collects the durations of each stage of a run."""
+
+    def __init__(self):
+        self.samples = dict()
+
+    def time(self, stage: str, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        self.samples.setdefault(stage, list()).append(time.perf_counter() - start)
+        return result
+
+    def report(self) -> dict:
+        result = dict()
+        for stage, samples in self.samples.items():
+            result[stage] = {"count": len(samples), "total": sum(samples), "mean": statistics.mean(samples),
+                             "median": statistics.median(samples), "max": max(samples)}
+        return result
+
+
+def run_benchmark(args: argparse.Namespace) -> dict:
+    svg = generate_document(args.groups, args.axes, args.layers, args.depth, args.static, args.image_kb, args.seed)
+
+    effect = export_layer_combos.ComboExport()
+    effect.options = effect.arg_parser.parse_args([f"--dpi={args.dpi}", f"--filetype={args.filetype}",
+                                                   f"--prune={args.prune}"])
+    effect.document = inkex.load_svg(io.BytesIO(svg))
+    if args.externalize_images:
+        effect.images = export_layer_combos.EmbeddedImages(effect.document)
+    # 250mm x 350mm at 96 user units per inch.
+    if args.renderer == "stub":
+        renderer = StubRenderer(250 / 25.4 * 96, 350 / 25.4 * 96)
+    elif args.renderer == "shell":
+        renderer = export_layer_combos.ShellRenderer()
+    else:
+        renderer = export_layer_combos.OneShotRenderer()
+
+    def logit(message: str):
+        pass
+
+    timer = StageTimer()
+    layers = timer.time("get_layers", effect.get_layers)
+
+    def expand() -> list:
+        combos = list()
+        groups = effect.find_groups(layers)
+        for group in groups:
+            for _, combo in export_layer_combos.iter_combos(effect.expand_group(groups[group])):
+                combos.append(effect.combo_visibility(combo))
+        return combos
+
+    combos = timer.time("expand_combos", expand)
+    if args.limit > 0:
+        combos = combos[:args.limit]
+
+    serialized = 0
+    try:
+        for show, hide in combos:
+            combo_svg = timer.time("serialize", effect.serialize_layers, show, hide)
+            serialized += len(combo_svg)
+            png = timer.time("render", renderer.render, combo_svg, args.dpi, logit)
+            timer.time("convert", effect.encode_image, png, args.filetype, logit)
+    finally:
+        renderer.close()
+        if effect.images is not None:
+            effect.images.restore()
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": vars(args),
+        "document": {"bytes": len(svg), "layers": len(layers), "combos": len(combos),
+                     "serialized_bytes": serialized},
+        "stages": timer.report(),
+    }
+
+
+def compare(result: dict, baseline: dict):
+    print(f"{'stage':<16}{'baseline':>12}{'current':>12}{'ratio':>8}", file=sys.stderr)
+    for stage, current in result["stages"].items():
+        before = baseline.get("stages", dict()).get(stage)
+        if before is None:
+            print(f"{stage:<16}{'-':>12}{current['total']:>12.4f}{'-':>8}", file=sys.stderr)
+        else:
+            ratio = current["total"] / before["total"] if before["total"] > 0 else float("inf")
+            print(f"{stage:<16}{before['total']:>12.4f}{current['total']:>12.4f}{ratio:>8.2f}", file=sys.stderr)
+
+
+def _main():
+    parser = argparse.ArgumentParser(description="Times each stage of exporting layer combos of a synthetic document.")
+    parser.add_argument("--groups", type=int, default=1, help="Number of combination groups")
+    parser.add_argument("--axes", type=int, default=2, help="combo-children layers per group")
+    parser.add_argument("--layers", type=int, default=10, help="Child layers per combo-children layer")
+    parser.add_argument("--depth", type=int, default=1, help="How deeply each child layer is nested")
+    parser.add_argument("--static", type=int, default=1, help="Always visible layers per group")
+    parser.add_argument("--image-kb", type=int, default=0, help="Size of the image embedded in each static layer")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the document generator")
+    parser.add_argument("--dpi", type=float, default=90.0, help="DPI of the renders")
+    parser.add_argument("--filetype", type=str, default="png", help="Converted file type. One of [png|jpeg|webp]")
+    parser.add_argument("--renderer", type=str, default="stub", help="One of [stub|shell|oneshot]")
+    parser.add_argument("--prune", action="store_true", help="Leave hidden layers out of the serialized combos")
+    parser.add_argument("--externalize-images", action="store_true", help="Link embedded images as files")
+    parser.add_argument("--limit", type=int, default=0, help="Only serialize, render and convert this many combos")
+    parser.add_argument("--output", type=str, default="", help="Write the JSON result here instead of stdout")
+    parser.add_argument("--compare", type=str, default="", help="An earlier JSON result to compare against")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    result = run_benchmark(args)
+    text = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fp:
+            fp.write(text + "\n")
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as fp:
+            compare(result, json.load(fp))
+
+
+if __name__ == "__main__":
+    _main()
+
+#######################################################################################################################
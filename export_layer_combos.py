@@ -49,6 +49,7 @@
 # JPEG output: magick montage *.jpg -rotate 90 -tile 2x3 -geometry +0+0 -resize 2480x3508 output.jpg
 # It's possible to add this functionality as options directly into the plugin but I wanted to change as little as
 # possible.
+# (The montage options of the plugin now do this while exporting, without decoding the exported files again.)
 #######################################################################################################################
 #
 # NOTES
@@ -69,29 +70,72 @@ import os
 import subprocess
 import tempfile
 import shutil
-import copy
+import base64
+import collections
+import cProfile
+import csv
+import hashlib
+import io
+import itertools
+import json
+import mimetypes
+import pathlib
+import re
+import concurrent.futures
+import queue
+import threading
+import time
 from lxml import etree
 import logging
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
 #######################################################################################################################
 
 
+def parse_area(area: str, source: str) -> str:
+    """Checks an export area, which is one of 'page', 'drawing' (what a combo draws), 'visible' (what any combo of
+       the group draws), '#id' (the bounding box of an object) or 'x0:y0:x1:y1' (in user units). A RuntimeError
+       naming 'source' is raised if it is none of these.
+    """
+    if area in ("page", "drawing", "visible") or (area.startswith("#") and len(area) > 1):
+        return area
+    try:
+        x0, y0, x1, y1 = (float(part) for part in area.split(":"))
+    except ValueError:
+        x0 = x1 = y0 = y1 = 0
+    if x0 >= x1 or y0 >= y1:
+        raise RuntimeError(f"{source} has an invalid export area '{area}'. " +
+                           f"Expected one of [page|drawing|visible|#id|x0:y0:x1:y1]")
+    return area
+
+
 class ExportSpec(object):
     """A description of how to export a layer."""
 
     ATTR_ID = "export-layer-combo"
     SELECTORS = ["combo-children", "visible", "hidden"]
 
-    def __init__(self, spec: str, layer: object, group: str, selector: str):
+    def __init__(self, spec: str, layer: object, group: str, selector: str, area: str = None):
         self.layer = layer
         self.spec = spec
         self.group = group
         self.selector = selector
+        self.area = area
 
     @staticmethod
     def create_specs(layer) -> list:
-        """Extracts '[group],[selector]' pairs from the layer's ATTR_ID attribute and returns them as a 
-           list of ExportSpec. A RuntimeError is raised if any are incorrectly formatted. 
+        """Extracts '[group],[selector]' pairs, optionally followed by ',area=[area]', from the layer's ATTR_ID
+           attribute and returns them as a list of ExportSpec. A RuntimeError is raised if any are incorrectly
+           formatted.
         """
         result = list()
         if ExportSpec.ATTR_ID not in layer.source.attrib:
@@ -100,9 +144,12 @@ class ExportSpec(object):
         spec = layer.source.attrib[ExportSpec.ATTR_ID]
         for group_selector in spec.split(";"):
             gs_split = group_selector.split(",")
+            area = None
+            if len(gs_split) == 3 and gs_split[2].startswith("area="):
+                area = parse_area(gs_split.pop()[len("area="):], f"layer '{layer.label}'(#{layer.id})")
             if len(gs_split) != 2:
                 raise RuntimeError(f"layer '{layer.label}'(#{layer.id}) has an invalid form '{gs_split}'. " +
-                                   f"Expected format is '[group],[selector]'")
+                                   f"Expected format is '[group],[selector]' or '[group],[selector],area=[area]'")
 
             group = gs_split[0]
             selector = gs_split[1]
@@ -110,104 +157,1106 @@ class ExportSpec(object):
                 raise RuntimeError(f"layer '{layer.label}'(#{layer.id}) has an invalid selector '{selector}'. " +
                                    f"Only the following are valid: {str(ExportSpec.SELECTORS)}")
 
-            result.append(ExportSpec(spec, layer, group, selector))
+            result.append(ExportSpec(spec, layer, group, selector, area))
 
         return result
 
-class CustomNamedTemporaryFile: 
-    """
-    MODIFIED FROM : https://stackoverflow.com/questions/23212435/permission-denied-to-write-to-my-temporary-file
-    This custom implementation is needed because of the following limitation of tempfile.NamedTemporaryFile:
-
-    > Whether the name can be used to open the file a second time, while the named temporary file is still open,
-    > varies across platforms (it can be so used on Unix; it cannot on Windows NT or later).
-    """
-    def __init__(self, mode='wb', suffix="", delete=True):
-        self._mode = mode
-        self._delete = delete
-        self.suffix = suffix
-
-    def __enter__(self):
-        # Generate a random temporary file name
-        file_name = os.path.join(tempfile.gettempdir(), os.urandom(24).hex())+self.suffix
-        # Ensure the file is created
-        open(file_name, "x").close()
-        # Open the file in the given mode
-        self._tempFile = open(file_name, self._mode)
-        return self._tempFile
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self._tempFile.close()
-        if self._delete:
-            os.remove(self._tempFile.name)
-
 class LayerRef(object):
     """A wrapper around an Inkscape XML layer object plus some helper data for doing combination exports."""
 
+    __slots__ = ["source", "id", "label", "children", "parent", "export_specs", "_child_ids", "_sibling_ids"]
+    LABEL = inkex.addNS("label", "inkscape")
+
     def __init__(self, source: etree.Element):
         self.source = source
         self.id = source.attrib["id"]
-        label_attrib_name = LayerRef.get_layer_attrib_name(source)
-        self.label = source.attrib[label_attrib_name]
+        self.label = source.attrib[LayerRef.LABEL]
         self.children = list()
         self.parent = None
-
-        self.export_specs = list()
-        self.request_hidden_state = False
-        self.requested_hidden = False
-        self.sibling_ids = list()
+        self._child_ids = None
+        self._sibling_ids = None
 
         self.export_specs = ExportSpec.create_specs(self)
 
-    @staticmethod
-    def get_layer_attrib_name(layer: etree.Element) -> str:
-        return "{%s}label" % layer.nsmap['inkscape']
-    
     def has_valid_export_spec(self):
         return len(self.export_specs) > 0
 
+    @property
+    def child_ids(self) -> tuple:
+        """The ids of the child layers, computed once."""
+        if self._child_ids is None:
+            self._child_ids = tuple(child.id for child in self.children)
+        return self._child_ids
+
+    @property
+    def sibling_ids(self) -> frozenset:
+        """The ids of the other child layers of the parent, computed once."""
+        if self._sibling_ids is None:
+            siblings = () if self.parent is None else self.parent.child_ids
+            self._sibling_ids = frozenset(id for id in siblings if id != self.id)
+        return self._sibling_ids
+
     def copy_with_hidden(self, is_hidden: bool, hide_siblings: bool = False):
-        result = LayerRef(self.source)
-        result.request_hidden_state = True
-        result.requested_hidden = is_hidden
-        result.requested_hide_siblings = hide_siblings
-        if self.parent is not None:
-            for layer in self.parent.children:
-                if layer.id != result.id:
-                    result.sibling_ids.append(layer.id)
-        return result
+        return LayerVisibility(self, is_hidden, hide_siblings)
+
+
+class LayerVisibility(object):
+    """The visibility a combo asks for of one layer. Only refers to the LayerRef, so combos stay cheap."""
+
+    __slots__ = ["layer", "requested_hidden", "requested_hide_siblings"]
+
+    def __init__(self, layer: LayerRef, requested_hidden: bool, requested_hide_siblings: bool):
+        self.layer = layer
+        self.requested_hidden = requested_hidden
+        self.requested_hide_siblings = requested_hide_siblings
+
+    @property
+    def id(self) -> str:
+        return self.layer.id
+
+    @property
+    def label(self) -> str:
+        return self.layer.label
+
+    @property
+    def source(self) -> etree.Element:
+        return self.layer.source
+
 
+class LayerIndex(object):
+    """Every labelled layer of a document, with its parent and children, built in a single walk over the tree.
+       'by_id' lists the layers with each id in document order (ids aren't always unique).
+    """
+
+    def __init__(self, document: etree.ElementTree):
+        self.layers = list()
+        self.by_id = dict()
+        by_element = dict()
 
-def recurse_combine(combo_items: list, idx: int = 0) -> list:
-    """Recursively expands 'combo_items' into a list of permutations.
-    
-        For example recurse_combine([[A, B, C], [D, E], [F]]) returns
+        # Layers come in document order, so a parent is always indexed before its children.
+        for element in document.xpath('//svg:g[@inkscape:groupmode="layer"]', namespaces=inkex.NSS):
+            if LayerRef.LABEL not in element.attrib:
+                continue
+            layer = LayerRef(element)
+            layer.parent = by_element.get(element.getparent())
+            if layer.parent is not None:
+                layer.parent.children.append(layer)
+            by_element[element] = layer
+            self.layers.append(layer)
+            self.by_id.setdefault(layer.id, list()).append(layer)
 
-        [[A, D, F], [A, E, F], [B, D, F], [B, E, F], [C, D, F], [C, E, F]]
-    
+
+def combo_axes(combo_items: list) -> list:
+    """Returns the lists of 'combo_items' that take part in combinations. Historically an empty list cut off every
+       list after it (and an empty first list meant no combinations at all), so the same is done here.
     """
+    for idx, items in enumerate(combo_items):
+        if len(items) == 0:
+            return combo_items[:idx]
+    return combo_items
+
+
+def count_combos(combo_items: list) -> int:
+    """Returns how many permutations 'combo_items' expands to, without expanding them."""
+    axes = combo_axes(combo_items)
+    if len(axes) == 0:
+        return 0
+    count = 1
+    for items in axes:
+        count *= len(items)
+    return count
+
+
+def combo_at(combo_items: list, index: int) -> list:
+    """Returns permutation number 'index' of 'combo_items', using the same order as iter_combos."""
     result = []
-    if idx < len(combo_items):
-        recurse_result = recurse_combine(combo_items, idx + 1)
-        for item in combo_items[idx]:
-            for sub_item in recurse_result:
-                sub_result = [item]
-                sub_result.extend(sub_item)
-                result.append(sub_result)
-            if len(recurse_result) == 0:
-                result.append([item])
+    for items in reversed(combo_axes(combo_items)):
+        index, item_idx = divmod(index, len(items))
+        result.append(items[item_idx])
+    result.reverse()
     return result
 
 
+def iter_combos(combo_items: list, shard: int = 0, shard_count: int = 1):
+    """Lazily expands 'combo_items' into permutations, yielding (index, permutation) pairs.
+
+        For example iter_combos([[A, B, C], [D, E], [F]]) yields the permutations
+
+        [A, D, F], [A, E, F], [B, D, F], [B, E, F], [C, D, F], [C, E, F]
+
+        with indices 0 to 5. With 'shard_count' above 1 only the permutations whose index modulo 'shard_count' is
+        'shard' are yielded, which splits the permutations into disjoint, evenly sized slices.
+    """
+    if len(combo_axes(combo_items)) == 0:
+        return
+    if shard_count == 1:
+        for index, combo in enumerate(itertools.product(*combo_axes(combo_items))):
+            yield index, list(combo)
+    else:
+        for index in range(shard, count_combos(combo_items), shard_count):
+            yield index, combo_at(combo_items, index)
+
+
+def recurse_combine(combo_items: list) -> list:
+    """Expands 'combo_items' into a list of all of its permutations (see iter_combos)."""
+    return [combo for _, combo in iter_combos(combo_items)]
+
+
+class VisibilityPatcher(object):
+    """Shows and hides layers of a document in place, serializes it, and then restores every layer it touched.
+
+       The layer elements come from the document's LayerIndex, so a combo only costs the style changes plus the
+       serialization instead of a deep copy of the whole document (and all of its embedded artwork).
+    """
+
+    # url(#id) references, in attributes as well as in style sheets.
+    URL_REFERENCE = re.compile(r"url\(\s*['\"]?#([^)'\"\s]+)")
+    UNPRUNABLE_DEFS = {inkex.addNS("style", "svg"), inkex.addNS("script", "svg")}
+    GROUPMODE = inkex.addNS("groupmode", "inkscape")
+
+    def __init__(self, document: etree.ElementTree, index: LayerIndex, prune: bool = False):
+        self.document = document
+        self.prune = prune
+        self.layers = {id: [layer.source for layer in layers] for id, layers in index.by_id.items()}
+        self.order = {id: order for order, id in enumerate(index.by_id)}
+        # Filled in by the first pruned serialize(), see _index_references.
+        self.hidden = None
+        self.defs = None
+        self.parents = None
+        self.references = None
+        self.unprunable = None
+        # How long the last serialize() spent patching styles and writing out the document.
+        self.patch_time = 0.0
+        self.write_time = 0.0
+
+    def serialize(self, show: set, hide: set, logit, hide_elements: list = ()) -> bytes:
+        """Returns the document serialized with the layers in 'show' set to 'display:inline' and the layers in
+           'hide' set to 'display:none' (hiding wins if a layer is in both), as well as any other elements in
+           'hide_elements' set to 'display:none'. If the patcher prunes, hidden subtrees and unused definitions are
+           left out as well (see _detach_hidden). The document is left unchanged.
+        """
+        patched = list()
+        detached = list()
+        start = time.perf_counter()
+        if self.prune and self.references is None:
+            self._index_references()
+        try:
+            for id in sorted((show | hide) & self.order.keys(), key=self.order.get):
+                for layer in self.layers[id]:
+                    label = layer.attrib.get(LayerRef.LABEL)
+                    patched.append((layer, layer.attrib.get("style")))
+                    if id in show:
+                        layer.attrib['style'] = 'display:inline'
+                        logit(f" ... showing layer '{label}'")
+                    if id in hide:
+                        layer.attrib['style'] = 'display:none'
+                        logit(f" ... hiding layer '{label}'")
+            for element in hide_elements:
+                patched.append((element, element.attrib.get("style")))
+                element.attrib['style'] = 'display:none'
+            if self.prune:
+                detached = self._detach_hidden(show, hide, hide_elements, logit)
+            patched_at = time.perf_counter()
+            result = etree.tostring(self.document)
+            self.write_time = time.perf_counter() - patched_at
+            return result
+        finally:
+            for parent, children in reversed(detached):
+                parent[:] = children
+            for element, style in reversed(patched):
+                if style is None:
+                    del element.attrib['style']
+                else:
+                    element.attrib['style'] = style
+            self.patch_time = time.perf_counter() - start - self.write_time
+
+    @staticmethod
+    def referenced_ids(node: etree.Element) -> set:
+        """Returns the ids that 'node' itself refers to, through url(#id) or an '#id' link like href."""
+        ids = set()
+        for value in node.attrib.values():
+            if value.startswith("#"):
+                ids.update(part[1:] for part in value.split(";") if part.startswith("#"))
+            elif "url(" in value:
+                ids.update(VisibilityPatcher.URL_REFERENCE.findall(value))
+        if node.text and node.tag in VisibilityPatcher.UNPRUNABLE_DEFS:
+            ids.update(VisibilityPatcher.URL_REFERENCE.findall(node.text))
+        return ids
+
+    def _index_references(self):
+        """Finds, once, everything pruning has to know about the document: the layers that are hidden in it, the
+           elements a <style> or <script> sits in, the prunable children of the top level <defs>, and for every id
+           that is referred to (through url(#id) or an '#id' link like href) the element defining it and the elements
+           referring to it, each with its ancestors.
+        """
+        root = self.document.getroot()
+        self.hidden = set()
+        self.unprunable = set()
+        self.defs = [child for defs in root.iterchildren(inkex.addNS("defs", "svg")) for child in defs
+                     if isinstance(child.tag, str) and "id" in child.attrib and child.tag not in self.UNPRUNABLE_DEFS]
+
+        defined = dict()
+        referrers = dict()
+        for node in root.iter():
+            if not isinstance(node.tag, str):
+                continue
+            defined.setdefault(node.attrib.get("id"), node)
+            for id in VisibilityPatcher.referenced_ids(node):
+                referrers.setdefault(id, list()).append(node)
+            # Style sheets apply to the whole document even where they are hidden, and so does a script.
+            if node.tag in self.UNPRUNABLE_DEFS:
+                self.unprunable.add(node)
+                self.unprunable.update(node.iterancestors())
+            # Unlabelled layers aren't indexed, but are just as prunable when hidden.
+            if node.attrib.get(VisibilityPatcher.GROUPMODE) == "layer" and style_property(node, "display") == "none":
+                self.hidden.add(node)
+        self.parents = {element: element.getparent() for element in list(self.hidden) + self.defs}
+
+        def chain(element: etree.Element) -> tuple:
+            return (element,) + tuple(element.iterancestors())
+
+        # Ids that aren't defined anywhere (colors like '#ffffff', for one) are dropped here.
+        self.references = {id: (chain(defined[id]), [chain(node) for node in nodes])
+                           for id, nodes in referrers.items() if id in defined}
+
+    def _detach_hidden(self, show: set, hide: set, hide_elements: list, logit) -> list:
+        """Takes hidden layers, 'hide_elements' and every top level definition that nothing left in the document
+           refers to out of the document, since Inkscape would only parse them to draw nothing. A hidden subtree
+           that defines something still referenced (a gradient, a clip path, the target of a <use>, ...) or holds a
+           <style> or <script> is kept.
+           Returns the original children of every parent that lost some, to restore them with.
+        """
+        removed = set(self.hidden)
+        for id in show - hide:
+            removed.difference_update(self.layers.get(id, ()))
+        for id in hide:
+            removed.update(self.layers.get(id, ()))
+        removed.update(hide_elements)
+        removed.update(self.defs)
+        removed.difference_update(self.unprunable)
+
+        changed = True
+        while changed:
+            changed = False
+            for definer, referrers in self.references.values():
+                blocking = [element for element in definer if element in removed]
+                if len(blocking) > 0 and any(removed.isdisjoint(referrer) for referrer in referrers):
+                    removed.difference_update(blocking)
+                    changed = True
+
+        detached = list()
+        for parent in {self.parents[element] if element in self.parents else element.getparent()
+                       for element in removed}:
+            children = list(parent)
+            parent[:] = [child for child in children if child not in removed]
+            detached.append((parent, children))
+        logit(f" ... pruned {len(removed)} hidden layers and unused definitions")
+        return detached
+
+
+class EmbeddedImages(object):
+    """Moves the base64 encoded data of embedded <image> elements into files for the duration of an export.
+
+       Without it every combo SVG carries (and Inkscape decodes) all of the document's embedded artwork again. The
+       images are decoded once into a temporary directory, named after their contents so that identical images are
+       only written once, and the <image> elements link to those files until restore() puts the data back.
+    """
+
+    HREFS = [inkex.addNS("href", "xlink"), "href"]
+
+    def __init__(self, document: etree.ElementTree):
+        self.directory = tempfile.mkdtemp(prefix="export-layer-combos-images-")
+        self.prefix = pathlib.Path(self.directory).as_uri() + "/"
+        self.replaced = list()
+        self.size = 0
+        for image in document.getroot().iter(inkex.addNS("image", "svg")):
+            for attribute in EmbeddedImages.HREFS:
+                value = image.attrib.get(attribute, "")
+                header, _, data = value.partition(",")
+                if not header.startswith("data:") or not header.endswith(";base64"):
+                    continue
+                try:
+                    content = base64.b64decode(data)
+                except ValueError:
+                    continue
+                extension = mimetypes.guess_extension(header[len("data:"):-len(";base64")]) or ""
+                name = hashlib.sha256(content).hexdigest() + extension
+                path = os.path.join(self.directory, name)
+                if not os.path.exists(path):
+                    with open(path, "wb") as fp:
+                        fp.write(content)
+                    self.size += len(content)
+                self.replaced.append((image, attribute, value))
+                image.attrib[attribute] = self.prefix + name
+
+    def normalize(self, svg: bytes) -> bytes:
+        """Returns 'svg' without the name of the temporary directory, which changes with every run."""
+        return svg.replace(self.prefix.encode("utf-8"), b"")
+
+    def restore(self):
+        """Embeds the images in the document again and removes their files."""
+        for image, attribute, value in reversed(self.replaced):
+            image.attrib[attribute] = value
+        self.replaced = list()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class OneShotRenderer(object):
+    """Renders an SVG to PNG by launching a fresh Inkscape process for every export. The SVG is piped in through
+       stdin and the PNG is read back from stdout, so no temporary files are involved.
+    """
+
+    def render(self, svg: bytes, dpi: float, logit, background_opacity: float = None, area: str = None) -> bytes:
+        command = ["inkscape", "--pipe", "--export-type=png", f"--export-dpi={dpi}", "--export-filename=-"]
+        if background_opacity is not None:
+            command.append(f"--export-background-opacity={background_opacity}")
+        if area == "drawing":
+            command.append("--export-area-drawing")
+        elif area is not None:
+            command.append(f"--export-area={area}")
+        logit(f"Running command '{' '.join(command)}'")
+
+        p = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, err = p.communicate(svg)
+        logit(f"stderr:\n{err}")
+        if p.returncode != 0 or not output.startswith(b"\x89PNG"):
+            raise RuntimeError(f"inkscape failed to render (exit code {p.returncode}):\n{err.decode(errors='replace')}")
+        return output
+
+    @staticmethod
+    def query_bounds(svg: bytes, logit, id: str = None) -> tuple:
+        """Returns the (x, y, width, height) in px of the object 'id', or of the whole drawing, as Inkscape sees it."""
+        command = ["inkscape", "--pipe", "--query-x", "--query-y", "--query-width", "--query-height"]
+        if id is not None:
+            command.append(f"--query-id={id}")
+        logit(f"Running command '{' '.join(command)}'")
+
+        p = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, err = p.communicate(svg)
+        try:
+            bounds = tuple(float(value) for value in output.decode().replace(",", " ").split())
+        except ValueError:
+            bounds = tuple()
+        if p.returncode != 0 or len(bounds) != 4:
+            raise RuntimeError(f"inkscape failed to measure {'#' + id if id else 'the drawing'} " +
+                               f"(exit code {p.returncode}):\n{err.decode(errors='replace')}")
+        return bounds
+
+    def close(self):
+        pass
+
+
+class ShellRenderer(object):
+    """Renders an SVG to PNG by sending actions to a long-lived `inkscape --shell` process.
+
+       Inkscape's cold start (fonts, extensions, GTK) usually costs more than rasterizing a single combo, so
+       the process is kept around between exports. A worker that crashes or stops answering is restarted, and
+       if shell mode can't be started at all every export falls back to the `OneShotRenderer`. Shell mode reads
+       and writes files, so each worker gets a private scratch directory that is reused for every export.
+    """
+
+    PROMPT = b"> "
+    START_TIMEOUT = 60.0
+    RENDER_TIMEOUT = 300.0
+    MAX_RESTARTS = 3
+
+    def __init__(self):
+        self.fallback = OneShotRenderer()
+        self.available = True
+        self.restarts = 0
+        self._process = None
+        self._output = None
+        self._background_opacity = None
+        self._area = None
+        self._scratch_dir = None
+
+    def _start(self, logit):
+        logit("Starting 'inkscape --shell' render worker")
+        self._scratch_dir = tempfile.mkdtemp(prefix="export-layer-combos-")
+        # Actions are separated by ';' and lines by newlines, so those paths can't be sent to the shell.
+        if any(c in self._scratch_dir for c in ";\n"):
+            raise RuntimeError(f"can't use scratch directory '{self._scratch_dir}' in shell mode")
+        self._process = subprocess.Popen(["inkscape", "--shell"], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                         stderr=subprocess.STDOUT)
+        self._output = queue.Queue()
+        reader = threading.Thread(target=ShellRenderer._pump, args=(self._process.stdout, self._output), daemon=True)
+        reader.start()
+        banner = self._read_until_prompt(ShellRenderer.START_TIMEOUT)
+        logit(f"Render worker ready:\n{banner}")
+
+    @staticmethod
+    def _pump(stream, output: queue.Queue):
+        """Forwards everything the worker prints to 'output'; None marks the end of the stream."""
+        while True:
+            chunk = os.read(stream.fileno(), 4096)
+            if not chunk:
+                output.put(None)
+                return
+            output.put(chunk)
+
+    def _read_until_prompt(self, timeout: float) -> str:
+        """Collects worker output until it prints its prompt. A RuntimeError is raised if the worker exits or
+           does not answer within 'timeout' seconds.
+        """
+        deadline = time.monotonic() + timeout
+        buffer = b""
+        while not buffer.endswith(ShellRenderer.PROMPT):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RuntimeError(f"render worker did not answer within {timeout} seconds")
+            try:
+                chunk = self._output.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            if chunk is None:
+                raise RuntimeError(f"render worker exited unexpectedly:\n{buffer.decode(errors='replace')}")
+            buffer += chunk
+        return buffer[:-len(ShellRenderer.PROMPT)].decode(errors="replace")
+
+    def _stop(self):
+        if self._scratch_dir is not None:
+            shutil.rmtree(self._scratch_dir, ignore_errors=True)
+            self._scratch_dir = None
+        if self._process is None:
+            return
+        try:
+            if self._process.poll() is None:
+                self._process.stdin.write(b"quit\n")
+                self._process.stdin.flush()
+                self._process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self._process.kill()
+            self._process.wait()
+        self._process.stdin.close()
+        self._process.stdout.close()
+        self._process = None
+        self._output = None
+        self._background_opacity = None
+        self._area = None
+
+    def _render_with_worker(self, svg: bytes, dpi: float, logit, background_opacity: float, area: str) -> bytes:
+        # Export options stick around between commands and there is no action to go back to the document's own
+        # background or to unset an export area, so the worker is restarted instead.
+        if (self._background_opacity is not None and self._background_opacity != background_opacity) or \
+                (self._area is not None and self._area != area):
+            self._stop()
+        if self._process is None or self._process.poll() is not None:
+            self._stop()
+            self._start(logit)
+
+        svg_path = os.path.join(self._scratch_dir, "combo.svg")
+        png_path = os.path.join(self._scratch_dir, "combo.png")
+        with open(svg_path, "wb") as fp:
+            fp.write(svg)
+        if os.path.exists(png_path):
+            os.remove(png_path)
+
+        command = f"file-open:{svg_path};export-type:png;export-dpi:{dpi};export-filename:{png_path};"
+        if background_opacity is not None:
+            command += f"export-background-opacity:{background_opacity};"
+            self._background_opacity = background_opacity
+        if area is not None:
+            command += "export-area-drawing;" if area == "drawing" else f"export-area:{area};"
+            self._area = area
+        command += "export-do;file-close\n"
+        logit(f"Sending command '{command.strip()}'")
+        self._process.stdin.write(command.encode("utf-8"))
+        self._process.stdin.flush()
+        output = self._read_until_prompt(ShellRenderer.RENDER_TIMEOUT)
+        logit(f"output:\n{output}")
+
+        if not os.path.exists(png_path):
+            raise RuntimeError(f"render worker did not produce '{png_path}'")
+        with open(png_path, "rb") as fp:
+            return fp.read()
+
+    def render(self, svg: bytes, dpi: float, logit, background_opacity: float = None, area: str = None) -> bytes:
+        while self.available:
+            try:
+                return self._render_with_worker(svg, dpi, logit, background_opacity, area)
+            except (OSError, RuntimeError) as e:
+                self._stop()
+                self.restarts += 1
+                if self.restarts > ShellRenderer.MAX_RESTARTS:
+                    logging.warning(f"Shell mode render worker failed too often ({e}), falling back to one-shot renders")
+                    self.available = False
+                else:
+                    logging.warning(f"Render worker failed ({e}), restarting it")
+
+        return self.fallback.render(svg, dpi, logit, background_opacity, area)
+
+    def close(self):
+        self._stop()
+
+
+class RenderCache(object):
+    """A manifest of the files exported into a directory, keyed by a hash of everything that decides their pixels
+       (the serialized combo SVG, the dpi, the file type and its quality). A combo whose key matches and whose file still
+       exists doesn't need to be rendered again.
+    """
+
+    FILE_NAME = ".export-layer-combos-cache.json"
+    VERSION = 2
+    # Attributes of <sodipodi:namedview> that Inkscape rewrites on every save (where the canvas was scrolled to, the
+    # window, the layer being edited) but that don't change a single pixel of the export.
+    NAMEDVIEW_TAG = re.compile(rb"<sodipodi:namedview\b[^>]*>")
+    VIEW_STATE_ATTRIBUTE = re.compile(rb'\s+inkscape:(?:zoom|cx|cy|current-layer|window-[\w-]+)="[^"]*"')
+
+    def __init__(self, directory: str, max_entries: int, max_age_days: float):
+        self.path = os.path.join(directory, RenderCache.FILE_NAME)
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 24 * 60 * 60
+        self.entries = dict()
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as fp:
+                    manifest = json.load(fp)
+                if manifest.get("version") == RenderCache.VERSION:
+                    self.entries = manifest["entries"]
+            except (OSError, ValueError, KeyError) as e:
+                logging.warning(f"Ignoring unreadable render cache '{self.path}': {e}")
+
+    @staticmethod
+    def normalize(svg: bytes) -> bytes:
+        """Returns the serialized 'svg' without the view state of its namedview, so moving around the canvas or
+           switching layers in Inkscape doesn't invalidate the cache.
+        """
+        return RenderCache.NAMEDVIEW_TAG.sub(lambda tag: RenderCache.VIEW_STATE_ATTRIBUTE.sub(b"", tag.group(0)), svg,
+                                             count=1)
+
+    @staticmethod
+    def key(svg: bytes, dpi: float, filetype: str, quality: int, render_dpi: float = None, area: str = None) -> str:
+        digest = hashlib.sha256(svg)
+        digest.update(f"|{dpi}|{filetype}|{quality}".encode("utf-8"))
+        # Images scaled down from a render at a higher DPI aren't the same as those rendered at their own DPI.
+        if render_dpi is not None and render_dpi != dpi:
+            digest.update(f"|{render_dpi}".encode("utf-8"))
+        if area is not None:
+            digest.update(f"|area={area}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def is_fresh(self, output_path: str, key: str) -> bool:
+        entry = self.entries.get(os.path.basename(output_path))
+        if entry is None or entry["key"] != key:
+            return False
+        try:
+            if os.path.getsize(output_path) != entry["size"]:
+                return False
+        except OSError:
+            return False
+        entry["used"] = time.time()
+        return True
+
+    def store(self, output_path: str, key: str):
+        self.entries[os.path.basename(output_path)] = {"key": key, "size": os.path.getsize(output_path),
+                                                       "used": time.time()}
+
+    def evict(self):
+        """Drops entries older than the maximum age, then the least recently used ones over the maximum count."""
+        oldest = time.time() - self.max_age
+        entries = [(name, entry) for name, entry in self.entries.items() if entry["used"] >= oldest]
+        entries.sort(key=lambda item: item[1]["used"], reverse=True)
+        self.entries = dict(entries[:self.max_entries])
+
+    def save(self):
+        self.evict()
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as fp:
+            json.dump({"version": RenderCache.VERSION, "entries": self.entries}, fp, indent=1, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+
+def style_property(element: etree.Element, name: str) -> str:
+    """Returns the value of the CSS property 'name' of 'element', taken from its style attribute or, failing that,
+       from the presentation attribute of the same name. None is returned if neither is set.
+    """
+    for declaration in element.attrib.get("style", "").split(";"):
+        key, _, value = declaration.partition(":")
+        if key.strip() == name:
+            return value.strip()
+    return element.attrib.get(name)
+
+
+class LayerCompositor(object):
+    """Builds the combos of a group by alpha-compositing layers that were each rendered only once.
+
+       Every combo of a group shares the same background (the static layers, with all combo-children layers
+       hidden) and only differs in which combo-children layers are shown. As long as those layers are drawn after
+       everything else and nothing blends across them, compositing their transparent renders over the background
+       (source-over, in document order) gives the same pixels as rendering the combo, for O(layers) renders
+       instead of O(combos).
+    """
+
+    NON_RENDERED = {inkex.addNS(tag, "svg") for tag in ["defs", "metadata", "style", "script", "title", "desc"]} | \
+                   {inkex.addNS("namedview", "sodipodi")}
+    GRAPHICS = {inkex.addNS(tag, "svg") for tag in ["path", "rect", "circle", "ellipse", "line", "polyline",
+                                                    "polygon", "text", "image", "use", "foreignObject"]}
+    GROUP_PROPERTIES = ["opacity", "filter", "mask", "clip-path", "mix-blend-mode"]
+    # Largest per-channel difference to a full render that --composite-verify accepts (rounding of 8 bit alpha).
+    TOLERANCE = 2
+
+    def __init__(self, show: set, hide: set, layers: dict, order: dict, area: str = None):
+        self.show = show
+        self.hide = hide
+        self.layers = layers
+        self.order = order
+        self.area = area
+        self.background = None
+        self.buffers = dict()
+
+    @staticmethod
+    def _is_neutral(name: str, value: str) -> bool:
+        if value is None or value in ["", "none", "normal"]:
+            return True
+        if name == "opacity":
+            try:
+                return float(value) >= 1.0
+            except ValueError:
+                return False
+        return False
+
+    def find_hazards(self, document: etree.ElementTree) -> list:
+        """Returns the reasons why compositing would not match a full render of the combos (empty if it would)."""
+        reasons = list()
+        layer_elements = {element: id for id, element in self.layers.items()}
+
+        for id, element in self.layers.items():
+            for ancestor in element.iterancestors():
+                ancestor_id = ancestor.attrib.get("id")
+                if ancestor in layer_elements:
+                    reasons.append(f"combo-children layer #{id} is inside combo-children layer #{ancestor_id}")
+                if ancestor_id in self.hide:
+                    reasons.append(f"combo-children layer #{id} is inside hidden layer #{ancestor_id}")
+                for name in LayerCompositor.GROUP_PROPERTIES:
+                    # Shown layers get their whole style replaced, so only their presentation attributes remain.
+                    value = ancestor.attrib.get(name) if ancestor_id in self.show else style_property(ancestor, name)
+                    if not LayerCompositor._is_neutral(name, value):
+                        reasons.append(f"'{name}' of #{ancestor_id} applies across combo-children layer #{id}")
+
+            inside_ids = {child.attrib.get("id") for child in element.iter()}
+            for use in element.iter(inkex.addNS("use", "svg")):
+                href = use.attrib.get(inkex.addNS("href", "xlink"), use.attrib.get("href", ""))
+                if href.startswith("#") and href[1:] not in inside_ids:
+                    reasons.append(f"combo-children layer #{id} uses {href} from outside of the layer")
+
+        for element in document.getroot().iter():
+            if not isinstance(element.tag, str):
+                continue
+            if not LayerCompositor._is_neutral("mix-blend-mode", style_property(element, "mix-blend-mode")):
+                reasons.append(f"#{element.attrib.get('id')} blends with what is behind it")
+            if {element.attrib.get("in"), element.attrib.get("in2")} & {"BackgroundImage", "BackgroundAlpha"}:
+                reasons.append(f"filter #{element.getparent().attrib.get('id')} reads the background")
+
+        # Anything visible drawn after the first combo-children layer would end up underneath it.
+        seen_layer = [False]
+
+        def walk(element: etree.Element, hidden: bool):
+            if not isinstance(element.tag, str) or element.tag in LayerCompositor.NON_RENDERED:
+                return
+            if element in layer_elements:
+                seen_layer[0] = True
+                return
+            id = element.attrib.get("id")
+            if id in self.hide:
+                hidden = True
+            elif id not in self.show and style_property(element, "display") == "none":
+                hidden = True
+            if not hidden and seen_layer[0] and element.tag in LayerCompositor.GRAPHICS:
+                reasons.append(f"#{id} is drawn on top of combo-children layers")
+            for child in element:
+                walk(child, hidden)
+
+        walk(document.getroot(), False)
+        return reasons
+
+    @staticmethod
+    def isolate(element: etree.Element) -> list:
+        """Returns every rendered element that has to be hidden so that only 'element' (and none of the content of
+           its ancestors) is drawn.
+        """
+        hidden = list()
+        while element.getparent() is not None:
+            for sibling in element.getparent():
+                if sibling is not element and isinstance(sibling.tag, str) and \
+                        sibling.tag not in LayerCompositor.NON_RENDERED:
+                    hidden.append(sibling)
+            element = element.getparent()
+        return hidden
+
+    @staticmethod
+    def _premultiply(png: bytes) -> "numpy.ndarray":
+        with Image.open(io.BytesIO(png)) as image:
+            pixels = numpy.asarray(image.convert("RGBA"), dtype=numpy.float32) / 255.0
+        pixels[..., :3] *= pixels[..., 3:]
+        return pixels
+
+    def load_background(self, png: bytes):
+        self.background = LayerCompositor._premultiply(png)
+
+    def load_layer(self, id: str, png: bytes):
+        """Keeps the part of the layer's render that has any coverage, with its offset into the image."""
+        pixels = LayerCompositor._premultiply(png)
+        if pixels.shape != self.background.shape:
+            raise RuntimeError(f"layer #{id} rendered at {pixels.shape}, but the background is {self.background.shape}")
+        rows = numpy.flatnonzero(pixels[..., 3].any(axis=1))
+        columns = numpy.flatnonzero(pixels[..., 3].any(axis=0))
+        if len(rows) == 0:
+            self.buffers[id] = None
+        else:
+            crop = pixels[rows[0]:rows[-1] + 1, columns[0]:columns[-1] + 1].copy()
+            self.buffers[id] = (crop, rows[0], columns[0])
+
+    def composite(self, ids: list) -> "numpy.ndarray":
+        """Returns the 8 bit RGBA image of the background with the layers in 'ids' drawn over it."""
+        result = self.background.copy()
+        for id in sorted(ids, key=self.order.get):
+            if self.buffers[id] is None:
+                continue
+            crop, top, left = self.buffers[id]
+            region = result[top:top + crop.shape[0], left:left + crop.shape[1]]
+            region *= 1.0 - crop[..., 3:]
+            region += crop
+
+        alpha = result[..., 3:]
+        numpy.divide(result[..., :3], alpha, out=result[..., :3], where=alpha > 0)
+        return numpy.clip(numpy.rint(result * 255.0), 0, 255).astype(numpy.uint8)
+
+
+def write_atomically(path: str, data: bytes):
+    """Writes 'data' to 'path' through a temporary file next to it, so 'path' never holds a partial image."""
+    temp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{os.getpid()}.tmp")
+    with open(temp_path, "wb") as fp:
+        fp.write(data)
+    os.replace(temp_path, path)
+
+
+def link_or_copy(source: str, path: str):
+    """Makes 'path' a hard link to 'source', or a copy of it where hard links aren't supported. Like
+       write_atomically, 'path' never holds a partial image.
+    """
+    temp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{os.getpid()}.tmp")
+    try:
+        os.link(source, temp_path)
+    except OSError:
+        shutil.copyfile(source, temp_path)
+    os.replace(temp_path, path)
+
+
+class ExportMetrics(object):
+    """Timings and sizes of every combo of an export run, and the reports written from them."""
+
+    STAGES = ["patch", "serialize", "render", "convert", "write"]
+    PERCENTILES = [50, 90, 99]
+    SLOWEST = 10
+    FILE_NAME = "export-layer-combos-report"
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.combos = list()
+
+    def add(self, label: str, output_path: str, status: str, timings: dict, size: int):
+        combo = {"label": label, "file": os.path.basename(output_path) if output_path else "", "status": status}
+        for stage in ExportMetrics.STAGES:
+            combo[stage] = timings.get(stage, 0.0)
+        combo["total"] = sum(combo[stage] for stage in ExportMetrics.STAGES)
+        combo["bytes"] = size
+        self.combos.append(combo)
+
+    @staticmethod
+    def _percentile(values: list, percentile: float) -> float:
+        """Nearest-rank percentile of the sorted list 'values'."""
+        if len(values) == 0:
+            return 0.0
+        return values[max(0, -(-len(values) * percentile // 100) - 1)]
+
+    def summary(self) -> dict:
+        """Sums up the combos. The single layer renders that --composite builds combos from aren't combos, so they
+           are only counted and timed in 'layer_renders'.
+        """
+        combos = [combo for combo in self.combos if combo["status"] != "layer"]
+        layers = [combo for combo in self.combos if combo["status"] == "layer"]
+        statuses = dict()
+        for combo in combos:
+            statuses[combo["status"]] = statuses.get(combo["status"], 0) + 1
+
+        stages = dict()
+        for stage in ExportMetrics.STAGES + ["total", "bytes"]:
+            values = sorted(combo[stage] for combo in combos)
+            stages[stage] = {"sum": sum(values), "mean": sum(values) / len(values) if values else 0.0,
+                             "max": values[-1] if values else 0.0}
+            for percentile in ExportMetrics.PERCENTILES:
+                stages[stage][f"p{percentile}"] = ExportMetrics._percentile(values, percentile)
+
+        slowest = sorted(combos, key=lambda combo: combo["total"], reverse=True)[:ExportMetrics.SLOWEST]
+        return {"wall_time": time.perf_counter() - self.start, "combos": statuses, "stages": stages,
+                "slowest": [{"label": combo["label"], "total": combo["total"]} for combo in slowest],
+                "layer_renders": {"count": len(layers), "total": sum(combo["total"] for combo in layers)}}
+
+    def write(self, directory: str, report: str) -> str:
+        """Writes the report ('json' or 'csv') into 'directory' and returns its path."""
+        path = os.path.join(directory, f"{ExportMetrics.FILE_NAME}.{report}")
+        if report == "csv":
+            with open(path, "w", encoding="utf-8", newline="") as fp:
+                writer = csv.DictWriter(fp, ["label", "file", "status"] + ExportMetrics.STAGES + ["total", "bytes"])
+                writer.writeheader()
+                writer.writerows(self.combos)
+        else:
+            with open(path, "w", encoding="utf-8") as fp:
+                json.dump({"summary": self.summary(), "combos": self.combos}, fp, indent=1)
+        return path
+
+
+class Montage(object):
+    """Packs exported combos onto pages, either a multi-page PDF or PNG atlases, while they are being exported.
+
+       Every combo reserves its cell when it is queued, so the layout follows combo order no matter which render
+       finishes first, and a page is written out (and dropped from memory) as soon as all of its cells are filled.
+       An index of where every label ended up is written next to the pages.
+    """
+
+    FILE_NAME = "export-layer-combos-montage"
+    # Width and height in millimeters.
+    PAGE_SIZES = {"a4": (210.0, 297.0), "a3": (297.0, 420.0), "letter": (215.9, 279.4)}
+
+    def __init__(self, directory: str, output: str, grid: str, page: str, dpi: float, rotate: bool):
+        try:
+            self.columns, self.rows = (int(part) for part in grid.lower().split("x"))
+        except ValueError:
+            self.columns, self.rows = 0, 0
+        if self.columns < 1 or self.rows < 1:
+            raise RuntimeError(f"--montage-grid '{grid}' is invalid. Expected format is 'COLUMNSxROWS', e.g. '2x3'")
+        if output not in ("pdf", "png"):
+            raise RuntimeError(f"--montage '{output}' is invalid. Expected one of [pdf|png]")
+        if page and page not in Montage.PAGE_SIZES:
+            raise RuntimeError(f"--montage-page '{page}' is invalid. Expected one of [{'|'.join(Montage.PAGE_SIZES)}]")
+
+        self.directory = directory
+        self.output = output
+        self.dpi = dpi
+        self.rotate = rotate
+        # Without a page size, pages are exactly as big as the grid of tiles, sized after the first tile.
+        self.page_size = None
+        self.cell_size = None
+        if page:
+            self.page_size = tuple(round(mm / 25.4 * dpi) for mm in Montage.PAGE_SIZES[page])
+            self.cell_size = (self.page_size[0] // self.columns, self.page_size[1] // self.rows)
+        self.cells = dict()
+        self.pages = dict()
+        self.written = 0
+        self.tiles = dict()
+        self.pdf_path = os.path.join(directory, f".{Montage.FILE_NAME}.pdf.{os.getpid()}.tmp")
+
+    def page_file(self, page: int) -> str:
+        if self.output == "pdf":
+            return f"{Montage.FILE_NAME}.pdf"
+        return f"{Montage.FILE_NAME}-{page + 1:03d}.png"
+
+    def reserve(self, label: str):
+        """Claims the next free cell for 'label', unless it already has one."""
+        self.cells.setdefault(label, len(self.cells))
+
+    def add(self, label: str, image):
+        """Draws the image of 'label' (PNG bytes, or the path of an exported image) into its cell."""
+        cell = self.cells.get(label)
+        if cell is None or label in self.tiles:
+            return
+        with Image.open(io.BytesIO(image) if isinstance(image, bytes) else image) as tile:
+            tile = tile.convert("RGBA")
+        if self.rotate:
+            tile = tile.transpose(Image.ROTATE_270)
+        if self.cell_size is None:
+            self.cell_size = tile.size
+            self.page_size = (tile.width * self.columns, tile.height * self.rows)
+        if tile.size != self.cell_size:
+            scale = min(self.cell_size[0] / tile.width, self.cell_size[1] / tile.height)
+            tile = tile.resize((max(1, round(tile.width * scale)), max(1, round(tile.height * scale))), Image.LANCZOS)
+
+        page, slot = divmod(cell, self.columns * self.rows)
+        if page not in self.pages:
+            # PDF pages have no alpha channel, so they start out white instead of transparent.
+            background = (255, 255, 255, 255) if self.output == "pdf" else (0, 0, 0, 0)
+            self.pages[page] = [Image.new("RGBA", self.page_size, background), 0]
+        row, column = divmod(slot, self.columns)
+        x = column * self.cell_size[0] + (self.cell_size[0] - tile.width) // 2
+        y = row * self.cell_size[1] + (self.cell_size[1] - tile.height) // 2
+        self.pages[page][0].alpha_composite(tile, (x, y))
+        self.pages[page][1] += 1
+        self.tiles[label] = {"file": self.page_file(page), "page": page + 1, "x": x, "y": y,
+                             "width": tile.width, "height": tile.height}
+        self.write_pages(final=False)
+
+    def write_pages(self, final: bool):
+        """Writes out the pages that are complete, in order. With 'final', all remaining pages are written."""
+        for page in sorted(self.pages):
+            if not final and (page != self.written or self.pages[page][1] < self.columns * self.rows):
+                break
+            image = self.pages.pop(page)[0]
+            if self.output == "pdf":
+                # Pillow appends to the PDF on disk, so earlier pages don't have to stay in memory.
+                image.convert("RGB").save(self.pdf_path, "PDF", resolution=self.dpi, append=self.written > 0)
+            else:
+                buffer = io.BytesIO()
+                image.save(buffer, "PNG")
+                write_atomically(os.path.join(self.directory, self.page_file(page)), buffer.getvalue())
+            self.written += 1
+
+    def close(self) -> str:
+        """Writes the remaining pages and the index, and returns the path of the index."""
+        self.write_pages(final=True)
+        if self.output == "pdf" and self.written > 0:
+            os.replace(self.pdf_path, os.path.join(self.directory, self.page_file(0)))
+        path = os.path.join(self.directory, f"{Montage.FILE_NAME}.json")
+        index = {"columns": self.columns, "rows": self.rows, "page_size": self.page_size, "cell_size": self.cell_size,
+                 "pages": self.written, "tiles": self.tiles}
+        write_atomically(path, json.dumps(index, indent=1).encode("utf-8"))
+        return path
+
+
+class RenderJob(object):
+    """A single combo handed to the render pool.
+
+       Messages logged while the job runs are kept on the job and replayed when it is collected, so the log
+       reads in combo order no matter which worker finished first.
+    """
+
+    def __init__(self, label: str, svg: bytes):
+        self.label = label
+        self.svg = svg
+        # (output_path, dpi, filetype, cache_key) of every image to write from the render. Jobs without any only
+        # keep the render in 'result'.
+        self.outputs = list()
+        self.background_opacity = None
+        # The export area passed on to the renderer, None for the page.
+        self.area = None
+        self.compositor = None
+        self.layer_ids = None
+        self.result = None
+        self.timings = dict()
+        # (timings, size) of every image written, in the order of 'outputs'.
+        self.written = list()
+        # (label, output_path, cache_key, timings) of later combos that serialized to the same SVG, see
+        # ComboExport.reuse.
+        self.duplicates = list()
+        self.messages = list()
+
+    def logit(self, message: str):
+        self.messages.append(message)
+
+
+class DocumentSnapshot(object):
+    """What ComboWatcher compares between two saves of a document.
+
+       Every layer's own content (its attributes and children, with sub-layers only standing in by their id) is
+       digested separately, so an edit is pinned on the layers it was made in. Whatever lies outside of layers is
+       digested as a whole, and the layers themselves (ids, labels, export attributes and nesting) make up the
+       structure that the combos are enumerated from.
+    """
+
+    LAYER = '//svg:g[@inkscape:groupmode="layer"][@id]'
+    NAMEDVIEW = inkex.addNS("namedview", "sodipodi")
+
+    def __init__(self, document: etree.ElementTree):
+        layers = document.xpath(DocumentSnapshot.LAYER, namespaces=inkex.NSS)
+        is_layer = set(layers)
+        self.digests = dict()
+        self.defines = dict()
+        self.visible = dict()
+        self.parents = dict()
+        self.referenced = set()
+        structure = list()
+        for layer in layers:
+            id = layer.attrib["id"]
+            parent = next((ancestor for ancestor in layer.iterancestors() if ancestor in is_layer), None)
+            self.parents[id] = None if parent is None else parent.attrib["id"]
+            self.visible[id] = style_property(layer, "display") != "none"
+            structure.append((id, layer.attrib.get(LayerRef.LABEL), layer.attrib.get(ExportSpec.ATTR_ID),
+                              self.parents[id]))
+            self.digests[id], self.defines[id] = self._digest(layer, is_layer)
+        self.structure = tuple(structure)
+        self.outside, _ = self._digest(document.getroot(), is_layer)
+        for node in document.getroot().iter():
+            if isinstance(node.tag, str):
+                self.referenced.update(VisibilityPatcher.referenced_ids(node))
+
+    def _digest(self, element: etree.Element, is_layer: set) -> tuple:
+        """Returns the digest of 'element' without the content of the layers in it, and the ids defined in it."""
+        digest = hashlib.sha256(repr((element.tag, sorted(element.attrib.items()), element.text)).encode("utf-8"))
+        ids = set()
+        for child in element:
+            if child in is_layer:
+                digest.update(f"<layer {child.attrib['id']}>{child.tail}".encode("utf-8"))
+            elif child.tag == DocumentSnapshot.NAMEDVIEW:
+                # Inkscape saves where the canvas was scrolled to with every edit, which doesn't change any combo.
+                digest.update(RenderCache.normalize(etree.tostring(child)))
+            else:
+                digest.update(etree.tostring(child))
+                ids.update(node.attrib["id"] for node in child.iter() if isinstance(node.tag, str) and "id" in node.attrib)
+        return digest.hexdigest(), ids
+
+    def is_shown(self, id: str, show: frozenset, hide: frozenset) -> bool:
+        """Returns whether the layer 'id' is drawn in a combo that shows 'show' and hides 'hide'."""
+        while id is not None:
+            if id in hide or (id not in show and not self.visible[id]):
+                return False
+            id = self.parents[id]
+        return True
+
+
+class ComboWatcher(object):
+    """Works out which combos an edit to a document could have changed, for --watch."""
+
+    def __init__(self, document: etree.ElementTree):
+        self.snapshot = DocumentSnapshot(document)
+        # The shown and hidden layer ids of every exported combo, by label.
+        self.combos = dict()
+
+    def record(self, label: str, show: list, hide: list):
+        self.combos[label] = (frozenset(show), frozenset(hide))
+
+    def update(self, document: etree.ElementTree) -> set:
+        """Takes in the next save of the document and returns the labels of the combos that have to be exported
+           again, or None if all of them do.
+        """
+        old, new = self.snapshot, DocumentSnapshot(document)
+        self.snapshot = new
+        if old.structure != new.structure or old.outside != new.outside:
+            return None
+        changed = [id for id, digest in new.digests.items() if digest != old.digests[id]]
+        referenced = old.referenced | new.referenced
+        if any(not (old.defines[id] | new.defines[id]).isdisjoint(referenced) for id in changed):
+            # Something in the layer (a gradient, the original of a clone, ...) may be drawn by other layers too.
+            return None
+
+        # A combo depends on every layer drawn in it, before or after the edit.
+        dependents = {id: set() for id in changed}
+        for label, (show, hide) in self.combos.items():
+            for id in changed:
+                if old.is_shown(id, show, hide) or new.is_shown(id, show, hide):
+                    dependents[id].add(label)
+        return set().union(*dependents.values())
+
+
 class ComboExport(inkex.Effect):
     """The core logic of exporting combinations of layers as images."""
 
+    EXTENSIONS = {"png": "png", "jpeg": "jpg", "webp": "webp"}
+
     def __init__(self):
         super().__init__()
+        self.patcher = None
+        self.layer_index = None
+        self.watcher = None
+        self.images = None
+        # With --watch, the labels of the combos to export again after an edit, or None to export all of them.
+        self.affected = None
         self.arg_parser.add_argument("--path", type=str, dest="path", default="~/", help="The directory to export into")
         self.arg_parser.add_argument('-f', '--filetype', type=str, dest='filetype', default='jpeg', 
-                                     help='Exported file type. One of [png|jpeg]')
-        self.arg_parser.add_argument("--dpi", type=float, dest="dpi", default=90.0, help="DPI of exported image")
+                                     help='Exported file type. One of [png|jpeg|webp], or a comma separated list')
+        self.arg_parser.add_argument("--quality", type=int, dest="quality", default=90,
+                                     help="Quality (1-100) of exported JPEG and WebP images")
+        self.arg_parser.add_argument("--dpi", type=str, dest="dpi", default="90",
+                                     help="DPI of exported image, or a comma separated list of them")
         self.arg_parser.add_argument("--ascii", type=inkex.Boolean, dest="ascii", default=False, 
                                      help="If true, removes non-ascii characters from layer names during export")
         self.arg_parser.add_argument("--negatives", type=inkex.Boolean, dest="negatives", default=False, 
@@ -217,141 +1266,408 @@ class ComboExport(inkex.Effect):
         self.arg_parser.add_argument("--debug", type=inkex.Boolean, dest="debug", default=False, help="Print debug messages as warnings")
         self.arg_parser.add_argument("--one", type=inkex.Boolean, dest="one", default=False, help='Stop after processing one combination')
         self.arg_parser.add_argument("--dry", type=inkex.Boolean, dest="dry", default=False, help="Don't actually do all of the exports")
+        self.arg_parser.add_argument("--jobs", type=int, dest="jobs", default=1,
+                                     help="How many combos are rendered at the same time")
+        self.arg_parser.add_argument("--shard", type=str, dest="shard", default="",
+                                     help="Only export slice 'i/N' (1 <= i <= N) of every group's combos, e.g. to split " +
+                                          "an export between several machines")
+        self.arg_parser.add_argument("--composite", type=inkex.Boolean, dest="composite", default=False,
+                                     help="If true, renders each combo-children layer once and composites the combos " +
+                                          "from those renders, where that gives the same result")
+        self.arg_parser.add_argument("--composite-verify", type=inkex.Boolean, dest="composite_verify", default=False,
+                                     help="If true, also renders composited combos in full and reports any difference")
+        self.arg_parser.add_argument("--force", type=inkex.Boolean, dest="force", default=False,
+                                     help="Render every combo, even ones the render cache says are up to date")
+        self.arg_parser.add_argument("--cache", type=inkex.Boolean, dest="cache", default=True,
+                                     help="If true, remembers what was exported so unchanged combos are skipped next time")
+        self.arg_parser.add_argument("--cache-max-entries", type=int, dest="cache_max_entries", default=10000,
+                                     help="How many exported files the render cache remembers")
+        self.arg_parser.add_argument("--cache-max-age", type=float, dest="cache_max_age", default=30.0,
+                                     help="How many days an unused render cache entry is kept")
+        self.arg_parser.add_argument("--report", type=str, dest="report", default="",
+                                     help="Write per-combo timings and sizes next to the exports. One of [|json|csv]")
+        self.arg_parser.add_argument("--profile", type=inkex.Boolean, dest="profile", default=False,
+                                     help="If true, writes a cProfile capture of the run next to the exports")
+        self.arg_parser.add_argument("--montage", type=str, dest="montage", default="",
+                                     help="Also packs the combos onto pages. One of [|pdf|png]")
+        self.arg_parser.add_argument("--montage-grid", type=str, dest="montage_grid", default="2x3",
+                                     help="Columns and rows of combos per montage page, as 'COLUMNSxROWS'")
+        self.arg_parser.add_argument("--montage-page", type=str, dest="montage_page", default="",
+                                     help="Paper size of the montage pages. One of [|a4|a3|letter]")
+        self.arg_parser.add_argument("--montage-rotate", type=inkex.Boolean, dest="montage_rotate", default=False,
+                                     help="If true, combos are turned 90 degrees clockwise on the montage pages")
+        self.arg_parser.add_argument("--dedup", type=inkex.Boolean, dest="dedup", default=True,
+                                     help="If true, combos that come out identical are rendered once and hard linked")
+        self.arg_parser.add_argument("--externalize-images", type=inkex.Boolean, dest="externalize_images",
+                                     default=False, help="If true, embedded images are handed to Inkscape as files")
+        self.arg_parser.add_argument("--prune", type=inkex.Boolean, dest="prune", default=False,
+                                     help="If true, leaves hidden layers and unused definitions out of the rendered SVGs")
+        self.arg_parser.add_argument("--renderer", type=str, dest="renderer", default="shell",
+                                     help="How Inkscape is invoked. One of [shell|oneshot]")
+        self.arg_parser.add_argument("--area", type=str, dest="area", default="page",
+                                     help="Exported area, unless a group sets its own. One of " +
+                                          "[page|drawing|visible|#id|x0:y0:x1:y1]")
+        self.arg_parser.add_argument("--watch", type=inkex.Boolean, dest="watch", default=False,
+                                     help="If true, keeps running and exports the combos changed by every save again")
+        self.arg_parser.add_argument("--watch-interval", type=float, dest="watch_interval", default=1.0,
+                                     help="Seconds between checks of the document for --watch")
 
     def effect(self):
+        if self.options.watch:
+            self.watch()
+        else:
+            self.export()
+
+    def watch(self):
+        """Exports all combos, and then, every time the document is saved, only those that the edit could have
+           changed, until interrupted.
+        """
+        logit = logging.warning if self.options.debug else logging.info
+        path = self.options.input_file
+        self.watcher = ComboWatcher(self.document)
+        self.export()
+        seen = os.stat(path).st_mtime_ns
+        logging.warning(f"Watching {path} for changes, press Ctrl+C to stop")
+        try:
+            while True:
+                time.sleep(self.options.watch_interval)
+                try:
+                    modified = os.stat(path).st_mtime_ns
+                except OSError:
+                    # Some editors replace the file when saving, so it can be gone for a moment.
+                    continue
+                if modified == seen:
+                    continue
+                try:
+                    document = inkex.load_svg(path)
+                except etree.XMLSyntaxError as error:
+                    logit(f"Skipping a change to {path} that can't be read (yet): {error}")
+                    continue
+                seen = modified
+                self.affected = self.watcher.update(document)
+                self.document = document
+                self.svg = document.getroot()
+                self.patcher = None
+                if self.affected is None:
+                    logging.warning(f"{path} changed, exporting all combos")
+                    self.watcher.combos.clear()
+                elif len(self.affected) == 0:
+                    logging.warning(f"{path} changed, but none of the combos did")
+                    continue
+                else:
+                    logging.warning(f"{path} changed, exporting {len(self.affected)} combos")
+                try:
+                    self.export()
+                except RuntimeError as error:
+                    logging.error(f"Export failed, waiting for the next change: {error}")
+        except KeyboardInterrupt:
+            pass
+
+    def export(self):
         logit = logging.warning if self.options.debug else logging.info
 
         logit(f"Options: {str(self.options)}")
 
-        layers = self.get_layers()
-        groups = dict()
+        # Every combo is rendered once, at the highest DPI asked for, and the other DPIs are scaled down from that.
+        self.variants = self.parse_variants()
+        self.dpi = self.variants[0][0]
+        self.dpi_suffixes = len({dpi for dpi, _ in self.variants}) > 1
+        parse_area(self.options.area, "--area")
 
-        # Figure out the groups of permutations.
-        for layer in layers:
-            if not layer.has_valid_export_spec():
-                continue
-            
-            logit(f"Found valid layer '{layer.label}' with '{len(layer.export_specs)}' exports, it has {len(layer.children)} children.")
-            for export in layer.export_specs:
-                if export.group not in groups:
-                    groups[export.group] = list()
-                groups[export.group].append(export)
+        # Each worker thread borrows its own renderer, so shell mode keeps one Inkscape process per job.
+        jobs = max(1, self.options.jobs)
+        self.renderers = queue.Queue()
+        for _ in range(jobs):
+            self.renderers.put(ShellRenderer() if self.options.renderer == "shell" else OneShotRenderer())
+        self.in_flight = collections.deque()
+        self.max_in_flight = 2 * jobs
+        self.output_path = os.path.expanduser(self.options.path)
+        self.cache = None
+        if self.options.cache and not self.options.dry:
+            if not os.path.exists(self.output_path):
+                logit(f"Creating directory path {self.output_path} because it does not exist")
+                os.makedirs(self.output_path)
+            self.cache = RenderCache(self.output_path, self.options.cache_max_entries, self.options.cache_max_age)
+        self.metrics = ExportMetrics()
+        # The exported image (or the job exporting it) of every distinct combo SVG, by cache key.
+        self.renders = dict()
+        self.montage = None
+        if self.options.montage and not self.options.dry:
+            if Image is None:
+                logging.warning("A montage needs Pillow, skipping it")
+            else:
+                self.montage = Montage(self.output_path, self.options.montage, self.options.montage_grid,
+                                       self.options.montage_page, self.dpi, self.options.montage_rotate)
+        profiler = cProfile.Profile() if self.options.profile else None
+        self.images = None
+
+        try:
+            if profiler is not None:
+                profiler.enable()
+            if self.options.externalize_images and not self.options.dry:
+                self.images = EmbeddedImages(self.document)
+                logit(f"Moved {len(self.images.replaced)} embedded images ({self.images.size} bytes) to "
+                      f"{self.images.directory}")
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+                self.pool = pool
+                self.export_groups()
+                self.drain()
+            if self.montage is not None and len(self.montage.cells) > 0:
+                logit(f"Wrote montage index to {self.montage.close()}")
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            while not self.renderers.empty():
+                self.renderers.get().close()
+            if self.cache is not None:
+                self.cache.save()
+            if self.images is not None:
+                self.images.restore()
+
+        summary = self.metrics.summary()
+        counts = ", ".join(f"{count} {status}" for status, count in summary["combos"].items())
+        logit(f"Finished in {summary['wall_time']:.2f}s ({counts or 'nothing exported'})")
+        if summary["layer_renders"]["count"] > 0:
+            logit(f"Composited from {summary['layer_renders']['count']} layer renders, which took "
+                  f"{summary['layer_renders']['total']:.2f}s")
+        if summary["combos"].get("duplicate", 0) > 0:
+            logit(f"Saved {summary['combos']['duplicate']} renders by reusing the images of identical combos")
+        if self.options.dry:
+            return
+        if self.options.report:
+            logit(f"Wrote report to {self.metrics.write(self.output_path, self.options.report)}")
+        if profiler is not None:
+            # Only the main thread is profiled, the worker threads show up as time spent waiting on them.
+            profile_path = os.path.join(self.output_path, f"{ExportMetrics.FILE_NAME}.prof")
+            profiler.dump_stats(profile_path)
+            logit(f"Wrote profile to {profile_path}")
+
+    def submit(self, job: RenderJob):
+        """Queues 'job' on the render pool. At most two jobs per worker are in flight at a time (the oldest one is
+           collected first), so memory stays bounded however many combos there are.
+        """
+        while len(self.in_flight) >= self.max_in_flight:
+            self.collect(*self.in_flight.popleft())
+        self.in_flight.append((job, self.pool.submit(self.run_job, job)))
+
+    def drain(self):
+        """Waits for every job in flight."""
+        while self.in_flight:
+            self.collect(*self.in_flight.popleft())
+
+    def collect(self, job: RenderJob, future: concurrent.futures.Future):
+        logit = logging.warning if self.options.debug else logging.info
+        try:
+            future.result()
+            if len(job.outputs) == 0:
+                self.metrics.add(job.label, None, "layer", job.timings, 0)
+            for index, (output_path, _, _, cache_key) in enumerate(job.outputs):
+                if self.cache is not None:
+                    self.cache.store(output_path, cache_key)
+                # The time spent on the render is only counted once, with the first image written from it.
+                timings, size = job.written[index]
+                if index == 0:
+                    timings = dict(job.timings, **timings)
+                self.metrics.add(job.label, output_path, "composited" if job.compositor else "rendered", timings, size)
+            if self.montage is not None and any(self.is_montage_variant(dpi, filetype)
+                                                for _, dpi, filetype, _ in job.outputs):
+                self.montage.add(job.label, job.result)
+                job.result = None
+        finally:
+            for message in job.messages:
+                logit(message)
+        for output_path, _, _, cache_key in job.outputs:
+            if self.renders.get(cache_key) is job:
+                self.renders[cache_key] = output_path
+        for label, output_path, cache_key, timings in job.duplicates:
+            self.reuse(self.renders[cache_key], label, output_path, cache_key, timings)
+
+    def reuse(self, primary, label: str, output_path: str, cache_key: str, timings: dict):
+        """Exports a combo that serialized to the same SVG as an earlier one by hard linking (or copying) the earlier
+           one's image. 'primary' is either the path of that image or, while it is still being rendered, its job.
+        """
+        logit = logging.warning if self.options.debug else logging.info
+        if isinstance(primary, RenderJob):
+            primary.duplicates.append((label, output_path, cache_key, timings))
+            return
+        if output_path != primary:
+            logit(f"Reusing {primary} for {output_path}, which is the same combo")
+            link_or_copy(primary, output_path)
+        if self.cache is not None:
+            self.cache.store(output_path, cache_key)
+        self.metrics.add(label, output_path, "duplicate", timings, os.path.getsize(output_path))
+        if self.montage is not None and output_path == self.variant_path(label, *self.variants[0]):
+            self.montage.add(label, output_path)
+
+    def run_job(self, job: RenderJob):
+        renderer = self.renderers.get()
+        try:
+            start = time.perf_counter()
+            if job.compositor is not None:
+                png = self.composite_png(job, renderer)
+            else:
+                png = renderer.render(job.svg, self.dpi, job.logit, job.background_opacity, job.area)
+            job.svg = None
+            job.timings["render"] = time.perf_counter() - start
+
+            if len(job.outputs) == 0 or self.montage is not None:
+                # The montage is drawn from the render, rather than decoding the exported file again.
+                job.result = png
+            for output_path, dpi, filetype, _ in job.outputs:
+                start = time.perf_counter()
+                data = self.encode_image(png, filetype, job.logit, dpi / self.dpi, dpi)
+                converted = time.perf_counter()
+
+                job.logit(f"Writing {filetype.upper()} to final location {output_path}")
+                write_atomically(output_path, data)
+                job.written.append(({"convert": converted - start, "write": time.perf_counter() - converted},
+                                    len(data)))
+        finally:
+            self.renderers.put(renderer)
+
+    def composite_png(self, job: RenderJob, renderer) -> bytes:
+        """Returns the composite of the job's layers as a PNG. With --composite-verify the combo is also rendered in
+           full and the two are compared.
+        """
+        job.logit(f"Compositing layers {job.layer_ids}")
+        pixels = job.compositor.composite(job.layer_ids)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels, "RGBA").save(buffer, "PNG", dpi=(self.dpi, self.dpi))
+        if not self.options.composite_verify:
+            return buffer.getvalue()
+
+        with Image.open(io.BytesIO(renderer.render(job.svg, self.dpi, job.logit, area=job.area))) as image:
+            full = numpy.asarray(image.convert("RGBA"), dtype=numpy.float32)
+
+        if full.shape != pixels.shape:
+            logging.warning(f"Composite of '{job.label}' is {pixels.shape}, but a full render is {full.shape}")
+            return buffer.getvalue()
+        # Colors of (nearly) transparent pixels don't matter, so the premultiplied values are compared.
+        composite = pixels.astype(numpy.float32)
+        for image in [full, composite]:
+            image[..., :3] *= image[..., 3:] / 255.0
+        difference = numpy.abs(full - composite).max()
+        if difference > LayerCompositor.TOLERANCE:
+            logging.warning(f"Composite of '{job.label}' differs from a full render by up to {difference:.1f}")
+        else:
+            job.logit(f"Composite matches a full render (largest difference {difference:.1f})")
+        return buffer.getvalue()
+
+    def parse_variants(self) -> list:
+        """Returns the (dpi, filetype) pairs of the images to export for every combo, highest DPI first, as requested
+           by --dpi and --filetype. A RuntimeError is raised if either is incorrectly formatted.
+        """
+        try:
+            dpis = sorted({float(part) for part in self.options.dpi.split(",") if part.strip()}, reverse=True)
+        except ValueError:
+            dpis = list()
+        if len(dpis) == 0 or dpis[-1] <= 0:
+            raise RuntimeError(f"--dpi '{self.options.dpi}' is invalid. Expected a DPI or a comma separated list")
+        filetypes = [part.strip().lower() for part in self.options.filetype.split(",") if part.strip()]
+        filetypes = list(dict.fromkeys(filetypes))
+        if len(filetypes) == 0 or not set(filetypes) <= ComboExport.EXTENSIONS.keys():
+            raise RuntimeError(f"--filetype '{self.options.filetype}' is invalid. Expected one or a comma separated "
+                               f"list of [{'|'.join(ComboExport.EXTENSIONS)}]")
+        return [(dpi, filetype) for dpi in dpis for filetype in filetypes]
+
+    def parse_shard(self) -> tuple:
+        """Returns the zero based (shard, shard_count) pair requested by --shard. A RuntimeError is raised if it is
+           incorrectly formatted.
+        """
+        if not self.options.shard:
+            return 0, 1
+        try:
+            shard, shard_count = (int(part) for part in self.options.shard.split("/"))
+        except ValueError:
+            shard, shard_count = 0, 0
+        if shard_count < 1 or not 1 <= shard <= shard_count:
+            raise RuntimeError(f"--shard '{self.options.shard}' is invalid. Expected format is 'i/N' with 1 <= i <= N")
+        return shard - 1, shard_count
+
+    def export_groups(self):
+        logit = logging.warning if self.options.debug else logging.info
+        shard, shard_count = self.parse_shard()
+        combos_before = 0
+
+        groups = self.find_groups(self.get_layers())
 
         # Now generate each permutation.
         for group in groups:
-            combo_list = groups[group]
-
-            # Expand the list.
-            expanded_list = list()
-            for export in combo_list:
-                # Add all children with hidden to set False, but with hidden siblings.
-                if export.selector == "combo-children":
-                    child_list = list()
-                    for child in export.layer.children:
-                        child_list.append(child.copy_with_hidden(False, hide_siblings=True))
-                    expanded_list.append(child_list)
-                # Add list with single item, but with hidden state set correctly.
-                elif export.selector in ["visible", "hidden"]:
-                    expanded_list.append([export.layer.copy_with_hidden(export.selector == "hidden")])
-            
+            expanded_list = self.expand_group(groups[group])
+
             # Create the permutations
-            combos = recurse_combine(expanded_list)
-            logit(f"Computed {len(combos)} combos:")
-            for combo in combos:
-                contents = ""
-                show = list()
-                hide = list()
-                # Figure out what to show and what to hide.
-                for item in combo:
-                    if item.requested_hidden:
-                        hide.append(item.id)
-                    else:
-                        show.append(item.id)
-                        # Also show all parent layers as well.
-                        parent = item.parent
-                        while parent is not None:
-                            show.append(parent.id)
-                            parent = parent.parent
-                        # If requested, hide siblings.
-                        if item.requested_hide_siblings:
-                            hide.extend(item.sibling_ids)
-
-                    if item.requested_hidden and not self.options.negatives:
-                        continue
-                    contents += f"-{'no-' if item.requested_hidden else ''}{item.label.replace(' ', '')}"
-            
-                label = f"{group}{contents}"
-                if self.options.ascii:
-                    label = label.encode("ascii", "ignore").decode()
-                if self.options.lower:
-                    label = label.lower()
+            combo_count = count_combos(expanded_list)
+            if shard_count > 1:
+                logit(f"Computed {combo_count} combos, exporting shard {shard + 1}/{shard_count} of them:")
+            else:
+                logit(f"Computed {combo_count} combos:")
+            # Shards are counted across groups so that groups with only a few combos don't all land in the first shard.
+            group_shard = (shard - combos_before) % shard_count
+            combos_before += combo_count
+            area = self.group_area(group, groups[group], expanded_list)
+            compositor = None
+            if self.options.composite and not self.options.dry:
+                compositor = self.create_compositor(group, expanded_list, area)
 
+            for _, combo in iter_combos(expanded_list, group_shard, shard_count):
+                show, hide = self.combo_visibility(combo)
+                label = self.combo_label(group, combo)
+                # A montage needs every combo, the cache keeps the unchanged ones cheap.
+                if self.affected is not None and label not in self.affected and self.montage is None:
+                    continue
                 logit(f"  {label}")
+                if self.watcher is not None:
+                    self.watcher.record(label, show, hide)
 
                 if self.options.dry:
                     logit(f"Skipping because --dry was specified")
                     continue
 
                 # Actually do the export into the destination path.
-                output_path = os.path.expanduser(self.options.path)
-                if not os.path.exists(os.path.join(output_path)):
-                    logit(f"Creating directory path {output_path} because it does not exist")
-                    os.makedirs(os.path.join(output_path))
-
-                # If OS is Windows, use a the CustomNamedTemporaryFile.
-                if os.name == "nt":
-                    with CustomNamedTemporaryFile(suffix=".svg") as fp_svg:
-                        layer_dest_svg_path = fp_svg.name
-                        logit(f"Writing SVG to temporary location {layer_dest_svg_path}")
-                        self.export_layers(layer_dest_svg_path, show, hide)
-
-                        if self.options.filetype == "jpeg":
-                            with CustomNamedTemporaryFile(suffix=".png") as fp_png:
-                                logit(f"Writing PNG to temporary location {fp_png.name}")
-                                self.export_to_png(layer_dest_svg_path, fp_png.name)
-                                layer_dest_jpg_path = os.path.join(output_path, f"{label}.jpg")
-                                logit(f"Writing JPEG to final location {layer_dest_jpg_path}")
-                                self.convert_png_to_jpeg(fp_png.name, layer_dest_jpg_path)
-                        else:
-                            layer_dest_png_path = os.path.join(output_path, f"{label}.png")
-                            logit(f"Writing PNG to final location {layer_dest_png_path}")
-                            self.export_to_png(layer_dest_svg_path, layer_dest_png_path)
-                else : # Otherwise, use the standard NamedTemporaryFile.
-                    with tempfile.NamedTemporaryFile(suffix=".svg") as fp_svg:
-                        layer_dest_svg_path = fp_svg.name
-                        logit(f"Writing SVG to temporary location {layer_dest_svg_path}")
-                        self.export_layers(layer_dest_svg_path, show, hide)
-
-                        if self.options.filetype == "jpeg":
-                            with tempfile.NamedTemporaryFile(suffix=".png") as fp_png:
-                                logit(f"Writing PNG to temporary location {fp_png.name}")
-                                self.export_to_png(layer_dest_svg_path, fp_png.name)
-                                layer_dest_jpg_path = os.path.join(output_path, f"{label}.jpg")
-                                logit(f"Writing JPEG to final location {layer_dest_jpg_path}")
-                                self.convert_png_to_jpeg(fp_png.name, layer_dest_jpg_path)
-                        else:
-                            layer_dest_png_path = os.path.join(output_path, f"{label}.png")
-                            logit(f"Writing PNG to final location {layer_dest_png_path}")
-                            self.export_to_png(layer_dest_svg_path, layer_dest_png_path)
-
-
-#                with tempfile.NamedTemporaryFile(suffix=".svg") as fp_svg:
-#                    layer_dest_svg_path = fp_svg.name
-#                    logit(f"Writing SVG to temporary location {layer_dest_svg_path}")
-#                    self.export_layers(layer_dest_svg_path, show, hide)
-#
-#                    if self.options.filetype == "jpeg":
-#                        with tempfile.NamedTemporaryFile(suffix=".png") as fp_png:
-#                            logit(f"Writing PNG to temporary location {fp_png.name}")
-#                            self.export_to_png(layer_dest_svg_path, fp_png.name)
-#                            layer_dest_jpg_path = os.path.join(output_path, f"{label}.jpg")
-#                            logit(f"Writing JPEG to final location {layer_dest_jpg_path}")
-#                            self.convert_png_to_jpeg(fp_png.name, layer_dest_jpg_path)
-#                    else:
-#                        layer_dest_png_path = os.path.join(output_path, f"{label}.png")
-#                        logit(f"Writing PNG to final location {layer_dest_png_path}")
-#                        self.export_to_png(layer_dest_svg_path, layer_dest_png_path)
-#                
+                if not os.path.exists(self.output_path):
+                    logit(f"Creating directory path {self.output_path} because it does not exist")
+                    os.makedirs(self.output_path)
+
+                if self.montage is not None:
+                    self.montage.reserve(label)
+                svg = self.serialize_layers(show, hide)
+                timings = {"patch": self.patcher.patch_time, "serialize": self.patcher.write_time}
+                # The temporary directory of externalized images changes between runs, the images don't.
+                key_svg = RenderCache.normalize(svg if self.images is None else self.images.normalize(svg))
+                job = None
+                for dpi, filetype in self.variants:
+                    output_path = self.variant_path(label, dpi, filetype)
+                    cache_key = RenderCache.key(key_svg, dpi, filetype, self.options.quality, self.dpi, area)
+                    fresh = self.cache is not None and self.cache.is_fresh(output_path, cache_key)
+                    if fresh and not self.options.force:
+                        logit(f"Skipping because {output_path} is up to date")
+                        self.metrics.add(label, output_path, "cached", timings, os.path.getsize(output_path))
+                        if self.montage is not None and self.is_montage_variant(dpi, filetype):
+                            self.montage.add(label, output_path)
+                        self.renders.setdefault(cache_key, output_path)
+                    elif self.options.dedup and cache_key in self.renders:
+                        # Another group (or naming variant) already exported exactly the same SVG.
+                        self.reuse(self.renders[cache_key], label, output_path, cache_key, timings)
+                    else:
+                        if job is None:
+                            job = RenderJob(label, svg)
+                            job.timings.update(timings)
+                            job.area = area
+                        job.outputs.append((output_path, dpi, filetype, cache_key))
+                        self.renders[cache_key] = job
+                    # The time spent serializing the combo is only counted once.
+                    timings = dict()
+
+                if job is not None:
+                    if compositor is not None:
+                        if compositor.background is None:
+                            self.render_compositor_layers(compositor)
+                        job.compositor = compositor
+                        job.layer_ids = [item.id for item in combo if item.requested_hide_siblings]
+                        if not self.options.composite_verify:
+                            job.svg = None
+                    self.submit(job)
+
                 # Break on first output for debug purposes
                 if self.options.one:
                     break
@@ -360,68 +1676,226 @@ class ComboExport(inkex.Effect):
             if self.options.one:
                     break
 
-        
-    def get_layers(self) -> list:
-        svg_layers = self.document.xpath('//svg:g[@inkscape:groupmode="layer"]', namespaces=inkex.NSS)
-        layers = []
+    def variant_path(self, label: str, dpi: float, filetype: str) -> str:
+        """Returns where the image of the combo 'label' is exported at 'dpi' as 'filetype'. The DPI is only part of
+           the file name if more than one was asked for.
+        """
+        suffix = f"-{dpi:g}dpi" if self.dpi_suffixes else ""
+        return os.path.join(self.output_path, f"{label}{suffix}.{ComboExport.EXTENSIONS[filetype]}")
 
-        # Find all of our "valid" layers.
-        for layer in svg_layers:
-            label_attrib_name = LayerRef.get_layer_attrib_name(layer)
-            if label_attrib_name not in layer.attrib:
-                continue
-            layers.append(LayerRef(layer))
+    def is_montage_variant(self, dpi: float, filetype: str) -> bool:
+        """Returns whether the montage is drawn from the images exported at 'dpi' as 'filetype'. That's the first
+           variant (the highest DPI, with the first file type), whether it is rendered, cached or reused.
+        """
+        return (dpi, filetype) == self.variants[0]
+
+    def find_groups(self, layers: list) -> dict:
+        """Returns the ExportSpecs of 'layers' by group name."""
+        logit = logging.warning if self.options.debug else logging.info
+        groups = dict()
 
-        # Create the layer hierarchy (children and parents).
+        # Figure out the groups of permutations.
         for layer in layers:
-            for other in layers:
-                for child in layer.source.getchildren():
-                    if child is other.source:
-                        layer.children.append(other)
-                if layer.source.getparent() is other.source:
-                    layer.parent = other 
+            if not layer.has_valid_export_spec():
+                continue
+            
+            logit(f"Found valid layer '{layer.label}' with '{len(layer.export_specs)}' exports, it has {len(layer.children)} children.")
+            for export in layer.export_specs:
+                if export.group not in groups:
+                    groups[export.group] = list()
+                groups[export.group].append(export)
+        return groups
 
-        return layers
+    def expand_group(self, combo_list: list) -> list:
+        """Expands the ExportSpecs of a group into the lists of layer visibilities that combos are picked from."""
+        expanded_list = list()
+        for export in combo_list:
+            # Add all children with hidden to set False, but with hidden siblings.
+            if export.selector == "combo-children":
+                child_list = list()
+                for child in export.layer.children:
+                    child_list.append(child.copy_with_hidden(False, hide_siblings=True))
+                expanded_list.append(child_list)
+            # Add list with single item, but with hidden state set correctly.
+            elif export.selector in ["visible", "hidden"]:
+                expanded_list.append([export.layer.copy_with_hidden(export.selector == "hidden")])
+        return expanded_list
 
-    def export_layers(self, dest: str, show: list, hide: list):
+    def combo_visibility(self, combo: list) -> tuple:
+        """Returns the (show, hide) lists of layer ids for a combination of layers."""
+        show = list()
+        hide = list()
+        for item in combo:
+            if item.requested_hidden:
+                hide.append(item.id)
+            else:
+                # Parent layers keep the visibility they have in the document.
+                show.append(item.id)
+                # If requested, hide siblings.
+                if item.requested_hide_siblings:
+                    hide.extend(item.layer.sibling_ids)
+        return show, hide
+
+    def combo_label(self, group: str, combo: list) -> str:
+        """Returns the name a combination of layers is exported under."""
+        contents = ""
+        for item in combo:
+            if item.requested_hidden and not self.options.negatives:
+                continue
+            contents += f"-{'no-' if item.requested_hidden else ''}{item.label.replace(' ', '')}"
+
+        label = f"{group}{contents}"
+        if self.options.ascii:
+            label = label.encode("ascii", "ignore").decode()
+        if self.options.lower:
+            label = label.lower()
+        return label
+
+    def create_compositor(self, group: str, expanded_list: list, area: str = None) -> LayerCompositor:
+        """Returns a LayerCompositor for the group, or None if its combos have to be rendered in full."""
         logit = logging.warning if self.options.debug else logging.info
-        doc = copy.deepcopy(self.document)
-        for layer in doc.xpath('//svg:g[@inkscape:groupmode="layer"]', namespaces=inkex.NSS):
-            id = layer.attrib["id"]
-            label_attrib_name = LayerRef.get_layer_attrib_name(layer)
-            label = layer.attrib[label_attrib_name]
-
-            if id in show:
-                layer.attrib['style'] = 'display:inline'
-                logit(f" ... showing layer '{label}'")
-            if id in hide:
-                layer.attrib['style'] = 'display:none'
-                logit(f" ... hiding layer '{label}'")
-        doc.write(dest)
-
-    def export_to_png(self, svg_path: str, output_path: str):
+        if numpy is None or Image is None:
+            logging.warning("Compositing needs NumPy and Pillow, rendering all combos in full")
+            return None
+        if area == "drawing":
+            logging.warning(f"Can't composite group '{group}', rendering its combos in full: "
+                            f"the export area differs between combos")
+            return None
+
+        axes = combo_axes(expanded_list)
+        static = [items[0] for items in axes if not items[0].requested_hide_siblings]
+        layers = [item for items in axes if items[0].requested_hide_siblings for item in items]
+        if len(layers) == 0:
+            return None
+
+        # The background is what every combo has in common: the static layers, with all combo-children layers hidden.
+        show, hide = self.combo_visibility(static)
+        hide.extend(item.id for item in layers)
+
+        if self.patcher is None:
+            self.patcher = VisibilityPatcher(self.document, self.layer_index, self.options.prune)
+        compositor = LayerCompositor(set(show), set(hide), {item.id: item.source for item in layers}, self.patcher.order,
+                                     area)
+
+        reasons = compositor.find_hazards(self.document)
+        if len(compositor.layers) != len(layers) or compositor.layers.keys() & {item.id for item in static}:
+            reasons.append("a layer is used more than once in the group")
+        if len(reasons) > 0:
+            logging.warning(f"Can't composite group '{group}', rendering its combos in full: {'; '.join(reasons)}")
+            return None
+
+        logit(f"Compositing group '{group}' from {len(layers)} layer renders")
+        return compositor
+
+    def group_area(self, group: str, exports: list, expanded_list: list) -> str:
+        """Returns the export area of the combos of a group, as handed to the renderer: None for the page, 'drawing',
+           or a rectangle 'x0:y0:x1:y1' in user units. 'visible' and '#id' areas are measured once, with every layer
+           that any combo of the group shows made visible. A RuntimeError is raised if the layers of the group ask for
+           different areas.
+        """
         logit = logging.warning if self.options.debug else logging.info
-        command = f"inkscape --export-type=\"png\" -d {self.options.dpi} --export-filename=\"{output_path}\" \"{svg_path}\""
-        logit(f"Running command '{command}'")
-       
-#        p = subprocess.Popen(command.encode("utf-8"), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        p = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        p.wait()
-        output, err = p.communicate()
-        logit(f"stdout:\n{output}")
-        logit(f"stderr:\n{err}")
+        areas = {export.area for export in exports if export.area is not None}
+        if len(areas) > 1:
+            raise RuntimeError(f"group '{group}' has more than one export area: {', '.join(sorted(areas))}")
+        area = areas.pop() if len(areas) > 0 else self.options.area
+        if area == "page":
+            return None
+        if area == "drawing" or ":" in area or self.options.dry:
+            return area
+
+        show = [item.id for items in expanded_list for item in items if not item.requested_hidden]
+        hide = [item.id for items in expanded_list for item in items if item.requested_hidden]
+        svg = self.serialize_layers(show, hide)
+        x, y, width, height = OneShotRenderer.query_bounds(svg, logit, area[1:] if area.startswith("#") else None)
+        # Inkscape measures in px, but export areas are in user units.
+        x0, y0, x1, y1 = (self.svg.unittouu(f"{value}px") for value in (x, y, x + width, y + height))
+        logit(f"Exporting group '{group}' with area '{area}' at {x0:g}:{y0:g}:{x1:g}:{y1:g}")
+        return f"{x0:g}:{y0:g}:{x1:g}:{y1:g}"
+
+    def render_compositor_layers(self, compositor: LayerCompositor):
+        """Renders the background and each of the layers of 'compositor' once and loads them into it."""
+        logit = logging.warning if self.options.debug else logging.info
+        jobs = dict()
+        for id in [None] + list(compositor.layers):
+            if id is None:
+                job = RenderJob("background", self.patcher.serialize(compositor.show, compositor.hide, logit))
+            else:
+                # Only the layer itself is drawn, over a transparent background.
+                svg = self.patcher.serialize({id}, set(), logit, LayerCompositor.isolate(compositor.layers[id]))
+                job = RenderJob(f"#{id}", svg)
+                job.background_opacity = 0.0
+            job.area = compositor.area
+            job.timings.update({"patch": self.patcher.patch_time, "serialize": self.patcher.write_time})
+            jobs[id] = job
+            self.submit(job)
+        self.drain()
+
+        compositor.load_background(jobs.pop(None).result)
+        for id, job in jobs.items():
+            compositor.load_layer(id, job.result)
+
+    def get_layers(self) -> list:
+        self.layer_index = LayerIndex(self.document)
+        return self.layer_index.layers
 
-    def convert_png_to_jpeg(self, png_path: str, output_path: str):
+    def serialize_layers(self, show: list, hide: list) -> bytes:
+        """Returns the document as it should be rendered with the layers in 'show' shown and those in 'hide' hidden."""
         logit = logging.warning if self.options.debug else logging.info
-        command = f"magick convert \"{png_path}\" \"{output_path}\""
-        logit(f"Running command '{command}'")
-
-#        p = subprocess.Popen(command.encode("utf-8"), shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        p = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        p.wait()
-        output, err = p.communicate()
-        logit(f"stdout:\n{output}")
+        if self.patcher is None:
+            self.patcher = VisibilityPatcher(self.document, self.layer_index, self.options.prune)
+        return self.patcher.serialize(set(show), set(hide), logit)
+
+    @staticmethod
+    def density_options(filetype: str, dpi: tuple) -> dict:
+        """Returns the arguments of Image.save() that record 'dpi'. WebP has no density of its own, so it is stored in
+           the EXIF resolution tags there.
+        """
+        if filetype != "webp":
+            return {"dpi": dpi}
+        exif = Image.Exif()
+        # XResolution, YResolution and ResolutionUnit (inches).
+        exif[0x011A], exif[0x011B], exif[0x0128] = round(float(dpi[0]), 2), round(float(dpi[1]), 2), 2
+        return {"exif": exif.tobytes()}
+
+    def encode_image(self, png: bytes, filetype: str, logit, scale: float = 1.0, dpi: float = None) -> bytes:
+        """Converts a PNG rendered by Inkscape to 'filetype', scaled down by 'scale' (with a Lanczos filter) if it is
+           below 1, and records 'dpi' as its density (the render's density is kept if it isn't given). This is done
+           in-process with Pillow when it is available, and by piping through ImageMagick otherwise.
+        """
+        if filetype == "png" and scale == 1.0:
+            return png
+
+        if Image is not None:
+            with Image.open(io.BytesIO(png)) as image:
+                # Keeps the density of the render, like ImageMagick does, so printed sizes don't change.
+                density = (dpi, dpi) if dpi is not None else image.info.get("dpi")
+                options = self.density_options(filetype, density) if density is not None else {}
+                # JPEG has no alpha channel, which is dropped just like ImageMagick does.
+                image = image.convert("RGB" if filetype == "jpeg" else "RGBA")
+                if scale != 1.0:
+                    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+                    if image.mode == "RGBA":
+                        # Filtering premultiplied colors keeps transparent pixels from bleeding into the edges.
+                        image = image.convert("RGBa").resize(size, Image.LANCZOS).convert("RGBA")
+                    else:
+                        image = image.resize(size, Image.LANCZOS)
+                buffer = io.BytesIO()
+                image.save(buffer, filetype.upper(), quality=self.options.quality, **options)
+            return buffer.getvalue()
+
+        command = ["magick", "png:-", "-quality", str(self.options.quality), f"{filetype}:-"]
+        if scale != 1.0:
+            command[2:2] = ["-filter", "Lanczos", "-resize", f"{scale * 100:g}%"]
+        if dpi is not None:
+            command[2:2] = ["-units", "PixelsPerInch", "-density", f"{dpi:g}"]
+        logit(f"Running command '{' '.join(command)}'")
+        p = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, err = p.communicate(png)
         logit(f"stderr:\n{err}")
+        if p.returncode != 0:
+            raise RuntimeError(f"magick failed to convert to {filetype} (exit code {p.returncode}):\n" +
+                               err.decode(errors="replace"))
+        return output
 
 #######################################################################################################################
 
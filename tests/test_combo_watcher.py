@@ -0,0 +1,42 @@
+"""Checks which combos --watch exports again after a save."""
+
+import io
+
+import export_layer_combos
+import inkex
+
+DOCUMENT = """<svg xmlns="http://www.w3.org/2000/svg" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape"
+     xmlns:sodipodi="http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd" width="100" height="60" id="svg">
+  <sodipodi:namedview id="namedview" pagecolor="{pagecolor}" inkscape:pageopacity="0" inkscape:zoom="{zoom}"
+      inkscape:cx="{cx}" inkscape:cy="30" inkscape:window-width="{window}" inkscape:window-x="0"
+      inkscape:current-layer="{current}"/>
+  <g inkscape:groupmode="layer" id="faces" inkscape:label="Faces" export-layer-combo="card,combo-children">
+    <g inkscape:groupmode="layer" id="jack" inkscape:label="Jack"><circle cx="40" cy="30" r="{radius}"/></g>
+    <g inkscape:groupmode="layer" id="queen" inkscape:label="Queen"><circle cx="50" cy="30" r="20"/></g>
+  </g>
+</svg>"""
+
+SAVED = {"pagecolor": "#ffffff", "zoom": "1", "cx": "50", "window": "800", "current": "faces", "radius": "15"}
+
+
+def load(**changes) -> inkex.SvgDocumentElement:
+    return inkex.load_svg(io.BytesIO(DOCUMENT.format(**dict(SAVED, **changes)).encode("utf-8")))
+
+
+def watcher() -> export_layer_combos.ComboWatcher:
+    result = export_layer_combos.ComboWatcher(load())
+    result.record("card-Jack", ["faces", "jack"], ["queen"])
+    result.record("card-Queen", ["faces", "queen"], ["jack"])
+    return result
+
+
+def test_view_changes_export_nothing():
+    assert watcher().update(load(zoom="2.5", cx="10", window="1024", current="jack")) == set()
+
+
+def test_layer_edit_exports_its_combos():
+    assert watcher().update(load(radius="10", current="jack")) == {"card-Jack"}
+
+
+def test_page_color_exports_everything():
+    assert watcher().update(load(pagecolor="#000000")) is None
@@ -0,0 +1,139 @@
+"""Checks that combos composited from single layer renders match combos drawn in one go."""
+
+import io
+import itertools
+import logging
+import random
+import shutil
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+
+import export_layer_combos
+import inkex
+
+LayerCompositor = export_layer_combos.LayerCompositor
+
+WIDTH, HEIGHT = 40, 30
+
+
+def encode(pixels: "numpy.ndarray") -> bytes:
+    buffer = io.BytesIO()
+    Image.fromarray(pixels, "RGBA").save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def random_layer(rng: random.Random, opaque: bool = False) -> "numpy.ndarray":
+    """Returns an RGBA image that only covers a random rectangle of the page, with random colors and alpha."""
+    generator = numpy.random.default_rng(rng.getrandbits(32))
+    pixels = numpy.zeros((HEIGHT, WIDTH, 4), dtype=numpy.uint8)
+    top, left = rng.randrange(HEIGHT - 5), rng.randrange(WIDTH - 5)
+    bottom, right = rng.randrange(top + 1, HEIGHT), rng.randrange(left + 1, WIDTH)
+    region = pixels[top:bottom, left:right]
+    region[...] = generator.integers(0, 256, region.shape, dtype=numpy.uint8)
+    if opaque:
+        pixels[..., 3] = 255
+        pixels[..., :3] = generator.integers(0, 256, (HEIGHT, WIDTH, 3), dtype=numpy.uint8)
+    return pixels
+
+
+def reference(background: "numpy.ndarray", layers: list) -> "numpy.ndarray":
+    """Composites 'layers' over 'background' (source-over, in order) with Pillow."""
+    result = Image.fromarray(background, "RGBA")
+    for layer in layers:
+        result = Image.alpha_composite(result, Image.fromarray(layer, "RGBA"))
+    return numpy.asarray(result)
+
+
+def assert_matches(composite: "numpy.ndarray", expected: "numpy.ndarray"):
+    assert composite.shape == expected.shape
+    # The color of a fully transparent pixel doesn't matter.
+    covered = expected[..., 3] > 0
+    difference = numpy.abs(composite.astype(int) - expected.astype(int))
+    assert difference[..., 3].max() <= LayerCompositor.TOLERANCE
+    assert difference[covered][..., :3].max(initial=0) <= LayerCompositor.TOLERANCE
+
+
+@pytest.mark.parametrize("opaque_background", [True, False])
+@pytest.mark.parametrize("seed", range(5))
+def test_composite_matches_alpha_composite(seed, opaque_background):
+    rng = random.Random(seed)
+    background = random_layer(rng, opaque_background)
+    layers = {f"layer{i}": random_layer(rng) for i in range(4)}
+    compositor = LayerCompositor(set(), set(), dict.fromkeys(layers), {id: i for i, id in enumerate(layers)})
+    compositor.load_background(encode(background))
+    for id, pixels in layers.items():
+        compositor.load_layer(id, encode(pixels))
+
+    for count in range(len(layers) + 1):
+        for ids in itertools.combinations(layers, count):
+            expected = reference(background, [layers[id] for id in ids])
+            # Layers are drawn in document order, whatever order they are asked for in.
+            assert_matches(compositor.composite(list(reversed(ids))), expected)
+
+
+def test_empty_layer_is_skipped():
+    rng = random.Random(0)
+    background = random_layer(rng, True)
+    compositor = LayerCompositor(set(), set(), {"empty": None}, {"empty": 0})
+    compositor.load_background(encode(background))
+    compositor.load_layer("empty", encode(numpy.zeros((HEIGHT, WIDTH, 4), dtype=numpy.uint8)))
+
+    assert compositor.buffers["empty"] is None
+    assert_matches(compositor.composite(["empty"]), background)
+
+
+def test_layer_of_another_size_is_refused():
+    compositor = LayerCompositor(set(), set(), {"layer": None}, {"layer": 0})
+    compositor.load_background(encode(numpy.zeros((HEIGHT, WIDTH, 4), dtype=numpy.uint8)))
+    with pytest.raises(RuntimeError):
+        compositor.load_layer("layer", encode(numpy.zeros((HEIGHT + 1, WIDTH, 4), dtype=numpy.uint8)))
+
+
+DOCUMENT = b"""<svg xmlns="http://www.w3.org/2000/svg" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape"
+     width="100" height="60" viewBox="0 0 100 60" id="svg">
+  <g inkscape:groupmode="layer" id="background" inkscape:label="Background" export-layer-combo="card,visible">
+    <rect x="0" y="0" width="100" height="60" fill="#eeeeee"/>
+  </g>
+  <g inkscape:groupmode="layer" id="faces" inkscape:label="Faces" export-layer-combo="card,combo-children">
+    <g inkscape:groupmode="layer" id="jack" inkscape:label="Jack"><circle cx="40" cy="30" r="15" fill="blue"/></g>
+    <g inkscape:groupmode="layer" id="queen" inkscape:label="Queen" style="display:none">
+      <circle cx="50" cy="30" r="20" fill="green" fill-opacity="0.5"/>
+    </g>
+  </g>
+  <g inkscape:groupmode="layer" id="suits" inkscape:label="Suits" export-layer-combo="card,combo-children">
+    <g inkscape:groupmode="layer" id="hearts" inkscape:label="Hearts">
+      <path d="M 45,20 L 70,45 L 20,45 Z" fill="red" fill-opacity="0.7"/>
+    </g>
+    <g inkscape:groupmode="layer" id="spades" inkscape:label="Spades"><rect x="60" y="5" width="30" height="20"/></g>
+  </g>
+</svg>"""
+
+
+@pytest.mark.skipif(shutil.which("inkscape") is None, reason="needs Inkscape")
+def test_composite_matches_full_render():
+    effect = export_layer_combos.ComboExport()
+    effect.options = effect.arg_parser.parse_args(["--composite=true"])
+    effect.document = inkex.load_svg(io.BytesIO(DOCUMENT))
+    groups = effect.find_groups(effect.get_layers())
+    expanded_list = effect.expand_group(groups["card"])
+    compositor = effect.create_compositor("card", expanded_list)
+    assert compositor is not None
+
+    renderer = export_layer_combos.OneShotRenderer()
+    dpi = 96.0
+    logit = logging.info
+    compositor.load_background(renderer.render(effect.patcher.serialize(compositor.show, compositor.hide, logit),
+                                               dpi, logit))
+    for id, element in compositor.layers.items():
+        svg = effect.patcher.serialize({id}, set(), logit, LayerCompositor.isolate(element))
+        compositor.load_layer(id, renderer.render(svg, dpi, logit, 0.0))
+
+    for _, combo in export_layer_combos.iter_combos(expanded_list):
+        show, hide = effect.combo_visibility(combo)
+        with Image.open(io.BytesIO(renderer.render(effect.serialize_layers(show, hide), dpi, logit))) as image:
+            full = numpy.asarray(image.convert("RGBA"))
+        composite = compositor.composite([item.id for item in combo if item.requested_hide_siblings])
+        assert_matches(composite, full)